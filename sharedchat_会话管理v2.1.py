@@ -1,9 +1,29 @@
 import json
 import os
 import re
+import sys
+import select
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import io
+import gzip
+import bz2
+import lzma
+import zlib
+import tarfile
+import zipfile
 import threading
+import time
+import queue
+import multiprocessing
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
 from pathlib import Path
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, ttk
@@ -17,6 +37,16 @@ import requests  # 用于检查 AI API 可访问性
 import html
 from jinja2 import Environment, select_autoescape
 
+try:
+    import ijson  # 可选依赖，用于流式解析大型JSON文件
+except ImportError:
+    ijson = None
+
+try:
+    import zstandard  # 可选依赖，用于读取 .zst 压缩文件
+except ImportError:
+    zstandard = None
+
 # 初始化 Jinja2 环境
 env = Environment(
     autoescape=select_autoescape(['html', 'xml'])
@@ -27,6 +57,13 @@ template = env.from_string("""
 <div class="message">
     <div class="author">{{ author_role }}</div>
     <div class="timestamp">{{ create_time_formatted }}</div>
+    {% if branch %}
+    <div class="branch">
+        {% if branch.previous %}<a href="branch:{{ branch.previous }}">‹</a>{% endif %}
+        分支 {{ branch.position }}/{{ branch.count }}
+        {% if branch.next %}<a href="branch:{{ branch.next }}">›</a>{% endif %}
+    </div>
+    {% endif %}
     <div class="content">{{ content_html | safe }}</div>
 </div>
 """)
@@ -39,12 +76,24 @@ template = env.from_string("""
 HOME_DIR = Path.home()
 # 定义配置文件路径
 CONFIG_FILE = HOME_DIR / ".sharedchat_config.json"
+# 数据库文件路径
+DB_FILE = 'conversations.db'
 # 默认配置
 DEFAULT_CONFIG = {
     "download_directory": "",
     "auto_import": False,
     "enable_ai_rename": False,
-    "auto_import_interval": 30000  # 默认时间间隔，单位为毫秒（30秒）
+    "auto_import_interval": 30000,  # 默认时间间隔，单位为毫秒（30秒），仅在无法监视目录时使用
+    "auto_import_debounce": 1000,  # 目录监视模式下，最后一个文件写完后等待多久再导入（毫秒）
+    "import_batch_size": 1000,  # 每次 executemany 写入的消息条数
+    "import_files_per_transaction": 200,  # 批量导入时每个事务包含的文件数
+    "bulk_import_mode": True,  # 批量导入期间临时放宽 synchronous/journal_mode
+    "import_workers": 0,  # 解析JSON的进程数，0 表示使用全部CPU核心
+    "stream_file_threshold": 64 * 1024 * 1024,  # 超过该大小(字节)的文件不进进程池，由写入线程流式解析
+    "compress_content": False,  # 是否压缩较长的消息内容
+    "compression_threshold": 1024,  # 超过该大小(字节)的消息内容才压缩
+    "compression_codec": "zstd",  # zstd 或 zlib，未安装 zstandard 时使用 zlib
+    "render_cache_memory_mb": 64  # 内存中缓存的已渲染消息HTML的上限（MB）
 }
 
 def load_config():
@@ -81,7 +130,7 @@ def open_config_dialog():
     config = load_config()
     dialog = tk.Toplevel(root)
     dialog.title("配置设置")
-    dialog.geometry("400x350")
+    dialog.geometry("400x640")
     dialog.resizable(False, False)
     dialog.transient(root)
     dialog.grab_set()
@@ -115,17 +164,46 @@ def open_config_dialog():
     enable_ai_rename_check = ttk.Checkbutton(dialog, text="启用AI自动重命名", variable=enable_ai_rename_var)
     enable_ai_rename_check.pack(pady=5, anchor='w', padx=10)
 
+    # 批量导入参数
+    ttk.Label(dialog, text="每批写入消息条数:").pack(pady=5, anchor='w', padx=10)
+    import_batch_size_var = tk.StringVar(value=str(config["import_batch_size"]))
+    ttk.Entry(dialog, textvariable=import_batch_size_var, width=10).pack(pady=5, padx=10, anchor='w')
+    ttk.Label(dialog, text="每个事务包含的文件数:").pack(pady=5, anchor='w', padx=10)
+    files_per_transaction_var = tk.StringVar(value=str(config["import_files_per_transaction"]))
+    ttk.Entry(dialog, textvariable=files_per_transaction_var, width=10).pack(pady=5, padx=10, anchor='w')
+    bulk_import_mode_var = tk.BooleanVar(value=config["bulk_import_mode"])
+    bulk_import_mode_check = ttk.Checkbutton(dialog, text="批量导入时启用快速写入模式", variable=bulk_import_mode_var)
+    bulk_import_mode_check.pack(pady=5, anchor='w', padx=10)
+
+    # 消息内容压缩
+    compress_content_var = tk.BooleanVar(value=config["compress_content"])
+    ttk.Checkbutton(dialog, text="压缩较长的消息内容", variable=compress_content_var).pack(pady=5, anchor='w', padx=10)
+    ttk.Label(dialog, text="压缩阈值（字节）:").pack(pady=5, anchor='w', padx=10)
+    compression_threshold_var = tk.StringVar(value=str(config["compression_threshold"]))
+    ttk.Entry(dialog, textvariable=compression_threshold_var, width=10).pack(pady=5, padx=10, anchor='w')
+    compression_button_frame = ttk.Frame(dialog)
+    compression_button_frame.pack(pady=5, padx=10, anchor='w')
+    ttk.Button(compression_button_frame, text="压缩现有消息", command=start_recompress_messages).pack(side=tk.LEFT)
+    ttk.Button(compression_button_frame, text="存储统计", command=show_compression_report).pack(side=tk.LEFT, padx=5)
+
     # 按钮框架
     button_frame = ttk.Frame(dialog)
     button_frame.pack(pady=10)
 
     def on_save():
-        new_config = {
+        # 保留对话框中未展示的配置项
+        new_config = dict(config)
+        new_config.update({
             "download_directory": download_dir_var.get(),
             "auto_import": auto_import_var.get(),
             "enable_ai_rename": enable_ai_rename_var.get(),
-            "auto_import_interval": int(auto_import_interval_var.get()) * 1000  # 转换为毫秒
-        }
+            "auto_import_interval": int(auto_import_interval_var.get()) * 1000,  # 转换为毫秒
+            "import_batch_size": max(1, int(import_batch_size_var.get())),
+            "import_files_per_transaction": max(1, int(files_per_transaction_var.get())),
+            "bulk_import_mode": bulk_import_mode_var.get(),
+            "compress_content": compress_content_var.get(),
+            "compression_threshold": max(0, int(compression_threshold_var.get()))
+        })
 
         if new_config["enable_ai_rename"]:
             if not check_ai_api_accessible():
@@ -133,6 +211,8 @@ def open_config_dialog():
                 new_config["enable_ai_rename"] = False
 
         save_config(new_config)
+        content_codec.configure(new_config)
+        render_cache.configure(new_config)
         dialog.destroy()
         messagebox.showinfo("配置已保存", "配置已成功保存。")
         update_batch_import_button_text()  # 更新按钮文本
@@ -169,138 +249,1803 @@ client = OpenAI(
     api_key='ollama',  # 必需，但未使用
 )
 
+# ====================== 数据库连接管理 ======================
+DB_BUSY_TIMEOUT = 30  # 等待其他进程释放写锁的秒数
+DB_READER_POOL_SIZE = 4  # 读连接池中保留的空闲连接数
+# 导入时一个事务最多持续的秒数，超过后提交并释放写锁，让界面上的写操作不必久等
+WRITE_TRANSACTION_MAX_SECONDS = 1.0
+
+def connect_db(db_file=DB_FILE, query_only=False):
+    """打开数据库连接，设置性能相关的 PRAGMA，并注册全文索引触发器用到的函数。
+
+    messages 表上的触发器会调用 fts_segment，所有可能写入消息的连接都必须通过这里打开。
+    连接可以在线程之间传递，但同一时间只能由一个线程使用。
+    """
+    conn = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+    conn.create_function('fts_segment', 1, fts_segment, deterministic=True)
+    # 迁移时为已有消息计算正文哈希和原文大小
+    conn.create_function('body_hash', 1, lambda content: content_body_hash(decode_content(content)), deterministic=True)
+    conn.create_function('body_size', 1, lambda content: len((decode_content(content) or '').encode('utf-8')), deterministic=True)
+    conn.execute('PRAGMA cache_size=-65536')  # 64MB 页缓存
+    conn.execute('PRAGMA mmap_size=268435456')  # 256MB 内存映射读取
+    conn.execute('PRAGMA temp_store=MEMORY')
+    if query_only:
+        conn.execute('PRAGMA query_only=ON')
+    return conn
+
+class ConnectionManager:
+    """数据库连接管理：WAL 模式下一个共享的写连接和一个读连接池。
+
+    所有写操作都通过 writer() 取得唯一的写连接，由锁保证同一时间只有一个线程在写，
+    避免多个连接争抢写锁出现 "database is locked"。读操作通过 reader() 借用只读连接，
+    WAL 模式下读取的是最近一次提交的快照，不会被正在进行的导入阻塞。
+    """
+
+    def __init__(self, db_file=DB_FILE, reader_pool_size=DB_READER_POOL_SIZE):
+        self.db_file = db_file
+        self.reader_pool_size = reader_pool_size
+        self.write_lock = threading.RLock()
+        self.write_conn = connect_db(db_file)
+        # journal_mode 会保存在数据库文件中；文件系统不支持 WAL 时保持原来的模式
+        self.journal_mode = self.write_conn.execute('PRAGMA journal_mode=WAL').fetchall()[0][0]
+        if self.journal_mode == 'wal':
+            # WAL 模式下 NORMAL 已能保证数据库不会损坏，只在断电时可能丢失最近的提交
+            self.write_conn.execute('PRAGMA synchronous=NORMAL')
+        self.readers = queue.LifoQueue()
+
+    @contextmanager
+    def writer(self):
+        """独占使用写连接。出错退出时回滚未提交的事务。"""
+        with self.write_lock:
+            try:
+                yield self.write_conn
+            except BaseException:
+                if self.write_conn.in_transaction:
+                    self.write_conn.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        """从连接池借用一个只读连接，用完后归还。"""
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            conn = connect_db(self.db_file, query_only=True)
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self.readers.qsize() < self.reader_pool_size:
+                self.readers.put(conn)
+            else:
+                conn.close()
+
+    def connect_reader(self):
+        """打开一个不放入连接池的只读连接，供界面线程长期使用。"""
+        return connect_db(self.db_file, query_only=True)
+
+    def close(self):
+        """关闭所有连接。"""
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+        with self.write_lock:
+            self.write_conn.close()
+
 # ====================== 数据库初始化 ======================
-def init_db():
-    """初始化SQLite数据库并创建必要的表。"""
+def init_db(db_file=DB_FILE, on_migration=None):
+    """初始化SQLite数据库，创建必要的表并执行迁移，返回连接管理器。on_migration 见 migrate_db。"""
     try:
-        conn = sqlite3.connect('conversations.db')
-        cursor = conn.cursor()
-        # 创建会话表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                conversation_id TEXT PRIMARY KEY,
-                conversation_name TEXT
-            )
-        ''')
-        # 创建消息表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                message_id TEXT PRIMARY KEY,
-                conversation_id TEXT,
-                author_role TEXT,
-                content TEXT,
-                create_time TEXT,
-                FOREIGN KEY (conversation_id) REFERENCES conversations (conversation_id)
-            )
-        ''')
-        conn.commit()
-        return conn
+        manager = ConnectionManager(db_file)
+    except sqlite3.Error as e:
+        messagebox.showerror("数据库错误", f"数据库初始化失败: {e}")
+        return None
+    try:
+        with manager.writer() as conn:
+            create_tables(conn)
+            migrate_db(conn, on_migration)
+        return manager
     except sqlite3.Error as e:
+        manager.close()
         messagebox.showerror("数据库错误", f"数据库初始化失败: {e}")
         return None
 
+def create_tables(conn):
+    """创建基础表（迁移之前的初始结构）。"""
+    cursor = conn.cursor()
+    # 创建会话表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id TEXT PRIMARY KEY,
+            conversation_name TEXT
+        )
+    ''')
+    # 创建消息表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id TEXT PRIMARY KEY,
+            conversation_id TEXT,
+            author_role TEXT,
+            content TEXT,
+            create_time TEXT,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (conversation_id)
+        )
+    ''')
+    # 创建导入记录表，记录每个已导入文件的内容哈希及其产生的会话
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS import_ledger (
+            content_hash TEXT PRIMARY KEY,
+            file_name TEXT,
+            file_size INTEGER,
+            file_mtime REAL,
+            conversation_id TEXT,
+            message_count INTEGER,
+            imported_at TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_import_ledger_file
+        ON import_ledger (file_name, file_size, file_mtime)
+    ''')
+    conn.commit()
+
+# ====================== 数据库迁移 ======================
+# 按版本顺序排列的迁移，每项为 (版本号, 说明, SQL语句列表)。
+# 已应用的版本记录在 PRAGMA user_version 中，只能在末尾追加新的迁移，不要修改已发布的迁移。
+MIGRATIONS = [
+    (1, "为消息和导入记录添加索引", [
+        # 加载会话消息、删除会话：按会话查找并按时间排序
+        '''CREATE INDEX IF NOT EXISTS idx_messages_conversation_time
+           ON messages (conversation_id, create_time)''',
+        # AI 重命名：查找会话中第一条用户消息
+        '''CREATE INDEX IF NOT EXISTS idx_messages_conversation_role_time
+           ON messages (conversation_id, author_role, create_time)''',
+        # 查看导入记录
+        '''CREATE INDEX IF NOT EXISTS idx_import_ledger_conversation
+           ON import_ledger (conversation_id, imported_at)''',
+    ]),
+    (2, "收集统计信息供查询优化器使用", [
+        'ANALYZE',
+    ]),
+    # 版本 3、4 曾各自建立一遍全文索引，随后又被版本 7 丢弃重建，均未发布，已并入版本 7：
+    # 全文索引在正文去重之后按 message_bodies 只建立一次，并且在界面启动后由后台分批建立
+    (3, "添加消息内容全文索引（已并入版本 7）", []),
+    (4, "全文索引改为中日韩二元分词（已并入版本 7）", []),
+    (5, "添加数值型消息时间和预先格式化的显示时间", [
+        # create_time 是导入时保存的原始字符串，按文本排序会把位数不同的时间戳排错；
+        # create_ts 为纪元秒数（未知时为 0），create_display 为本地时间的显示文本（未知时为 NULL）
+        'ALTER TABLE messages ADD COLUMN create_ts REAL NOT NULL DEFAULT 0',
+        'ALTER TABLE messages ADD COLUMN create_display TEXT',
+        '''UPDATE messages SET create_ts = MAX(CAST(create_time AS REAL), 0)''',
+        '''UPDATE messages SET create_display = strftime('%Y-%m-%d %H:%M:%S', create_ts, 'unixepoch', 'localtime')
+           WHERE create_ts > 0''',
+        'DROP INDEX IF EXISTS idx_messages_conversation_time',
+        'DROP INDEX IF EXISTS idx_messages_conversation_role_time',
+        '''CREATE INDEX idx_messages_conversation_ts
+           ON messages (conversation_id, create_ts)''',
+        '''CREATE INDEX idx_messages_conversation_role_ts
+           ON messages (conversation_id, author_role, create_ts)''',
+        'ANALYZE',
+    ]),
+    (6, "添加消息内容压缩字典表", [
+        '''CREATE TABLE IF NOT EXISTS compression_dicts (
+               dict_id INTEGER PRIMARY KEY,
+               dictionary BLOB NOT NULL,
+               sample_count INTEGER,
+               created_at TEXT
+           )''',
+    ]),
+    (7, "消息正文按内容哈希去重存储", [
+        # 相同的正文（系统提示、重复导入的会话等）只存一份，messages 通过 body_id 引用。
+        # body_id 是显式的 INTEGER PRIMARY KEY，VACUUM 不会改变它，全文索引改为按正文建立
+        '''CREATE TABLE message_bodies (
+               body_id INTEGER PRIMARY KEY,
+               body_hash BLOB NOT NULL UNIQUE,
+               content,
+               size INTEGER NOT NULL
+           )''',
+        '''INSERT OR IGNORE INTO message_bodies (body_hash, content, size)
+           SELECT body_hash(content), content, body_size(content) FROM messages ORDER BY rowid''',
+        'ALTER TABLE messages ADD COLUMN body_id INTEGER',
+        '''UPDATE messages SET body_id = (
+               SELECT body_id FROM message_bodies WHERE body_hash = body_hash(messages.content))''',
+        # 早期开发版本在 messages 上建立的全文索引
+        'DROP TRIGGER IF EXISTS messages_fts_insert',
+        'DROP TRIGGER IF EXISTS messages_fts_delete',
+        'DROP TRIGGER IF EXISTS messages_fts_update',
+        'DROP TABLE IF EXISTS messages_fts',
+        'ALTER TABLE messages DROP COLUMN content',
+        'CREATE INDEX idx_messages_body ON messages (body_id)',
+        # 中日韩文字在写入前由 fts_segment 切成二元词组，索引内容和原文不同，因此使用无内容表，
+        # 匹配片段由 Python 生成。新正文由 store_message_bodies 写入索引
+        '''CREATE VIRTUAL TABLE messages_fts
+           USING fts5(content, content='', tokenize='unicode61 remove_diacritics 2')''',
+        # 已有正文的索引由 build_fts_index_in_background 在界面启动后分批建立，
+        # 这里只记录需要补建的 body_id 范围 [next_body_id, last_body_id]，不阻塞启动
+        '''CREATE TABLE fts_backfill (
+               next_body_id INTEGER NOT NULL,
+               last_body_id INTEGER NOT NULL
+           )''',
+        '''INSERT INTO fts_backfill (next_body_id, last_body_id)
+           SELECT MIN(body_id), MAX(body_id) FROM message_bodies HAVING COUNT(*) > 0''',
+        # 正文的原文由哈希确定、不会改变（压缩只改变存储形式），因此不需要 UPDATE 触发器；
+        # 尚未补建索引的正文被删除时，索引中没有它的词项，不能写入删除记录
+        '''CREATE TRIGGER message_bodies_fts_delete AFTER DELETE ON message_bodies
+           WHEN NOT EXISTS (SELECT 1 FROM fts_backfill WHERE old.body_id BETWEEN next_body_id AND last_body_id) BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.body_id, fts_segment(old.content));
+           END''',
+        # 删除消息或更换正文后，清理不再被任何消息引用的正文
+        '''CREATE TRIGGER messages_body_release_delete AFTER DELETE ON messages BEGIN
+               DELETE FROM message_bodies WHERE body_id = old.body_id
+                   AND NOT EXISTS (SELECT 1 FROM messages WHERE body_id = old.body_id);
+           END''',
+        '''CREATE TRIGGER messages_body_release_update AFTER UPDATE OF body_id ON messages
+           WHEN old.body_id IS NOT new.body_id BEGIN
+               DELETE FROM message_bodies WHERE body_id = old.body_id
+                   AND NOT EXISTS (SELECT 1 FROM messages WHERE body_id = old.body_id);
+           END''',
+        'ANALYZE',
+    ]),
+    (8, "添加由触发器维护的会话统计表", [
+        # 每个会话一行，插入会话时创建、删除会话时删除；消息的增删改由触发器增量更新计数和字节数。
+        # first_ts/last_ts 只统计有时间的消息（create_ts > 0），删除或修改消息后按索引重新取最值
+        '''CREATE TABLE conversation_stats (
+               conversation_id TEXT PRIMARY KEY,
+               message_count INTEGER NOT NULL DEFAULT 0,
+               user_count INTEGER NOT NULL DEFAULT 0,
+               assistant_count INTEGER NOT NULL DEFAULT 0,
+               first_ts REAL,
+               last_ts REAL,
+               bytes INTEGER NOT NULL DEFAULT 0
+           )''',
+        'CREATE INDEX idx_conversation_stats_last_ts ON conversation_stats (last_ts)',
+        'CREATE INDEX idx_conversation_stats_message_count ON conversation_stats (message_count)',
+        'CREATE INDEX idx_conversation_stats_bytes ON conversation_stats (bytes)',
+        '''INSERT INTO conversation_stats (conversation_id, message_count, user_count, assistant_count, first_ts, last_ts, bytes)
+           SELECT c.conversation_id, COUNT(m.message_id),
+                  COALESCE(SUM(m.author_role = 'user'), 0), COALESCE(SUM(m.author_role = 'assistant'), 0),
+                  MIN(NULLIF(m.create_ts, 0)), MAX(NULLIF(m.create_ts, 0)), COALESCE(SUM(b.size), 0)
+           FROM conversations c
+           LEFT JOIN messages m ON m.conversation_id = c.conversation_id
+           LEFT JOIN message_bodies b ON b.body_id = m.body_id
+           GROUP BY c.conversation_id''',
+        '''CREATE TRIGGER conversations_stats_insert AFTER INSERT ON conversations BEGIN
+               INSERT OR IGNORE INTO conversation_stats (conversation_id) VALUES (new.conversation_id);
+           END''',
+        '''CREATE TRIGGER conversations_stats_delete AFTER DELETE ON conversations BEGIN
+               DELETE FROM conversation_stats WHERE conversation_id = old.conversation_id;
+           END''',
+        '''CREATE TRIGGER messages_stats_insert AFTER INSERT ON messages BEGIN
+               INSERT INTO conversation_stats (conversation_id, message_count, user_count, assistant_count, first_ts, last_ts, bytes)
+               VALUES (new.conversation_id, 1, new.author_role = 'user', new.author_role = 'assistant',
+                       NULLIF(new.create_ts, 0), NULLIF(new.create_ts, 0),
+                       COALESCE((SELECT size FROM message_bodies WHERE body_id = new.body_id), 0))
+               ON CONFLICT (conversation_id) DO UPDATE SET
+                   message_count = message_count + 1,
+                   user_count = user_count + excluded.user_count,
+                   assistant_count = assistant_count + excluded.assistant_count,
+                   first_ts = COALESCE(MIN(first_ts, excluded.first_ts), first_ts, excluded.first_ts),
+                   last_ts = COALESCE(MAX(last_ts, excluded.last_ts), last_ts, excluded.last_ts),
+                   bytes = bytes + excluded.bytes;
+           END''',
+        # 统计更新需要读取旧正文的大小，必须在释放正文之前执行，因此与释放正文合并为同一个触发器
+        'DROP TRIGGER IF EXISTS messages_body_release_delete',
+        'DROP TRIGGER IF EXISTS messages_body_release_update',
+        '''CREATE TRIGGER messages_after_delete AFTER DELETE ON messages BEGIN
+               UPDATE conversation_stats SET
+                   message_count = message_count - 1,
+                   user_count = user_count - (old.author_role = 'user'),
+                   assistant_count = assistant_count - (old.author_role = 'assistant'),
+                   first_ts = (SELECT MIN(create_ts) FROM messages WHERE conversation_id = old.conversation_id AND create_ts > 0),
+                   last_ts = (SELECT MAX(create_ts) FROM messages WHERE conversation_id = old.conversation_id AND create_ts > 0),
+                   bytes = bytes - COALESCE((SELECT size FROM message_bodies WHERE body_id = old.body_id), 0)
+               WHERE conversation_id = old.conversation_id;
+               DELETE FROM message_bodies WHERE body_id = old.body_id
+                   AND NOT EXISTS (SELECT 1 FROM messages WHERE body_id = old.body_id);
+           END''',
+        '''CREATE TRIGGER messages_after_update
+           AFTER UPDATE OF conversation_id, author_role, body_id, create_ts ON messages BEGIN
+               UPDATE conversation_stats SET
+                   message_count = message_count - 1,
+                   user_count = user_count - (old.author_role = 'user'),
+                   assistant_count = assistant_count - (old.author_role = 'assistant'),
+                   bytes = bytes - COALESCE((SELECT size FROM message_bodies WHERE body_id = old.body_id), 0)
+               WHERE conversation_id = old.conversation_id;
+               UPDATE conversation_stats SET
+                   message_count = message_count + 1,
+                   user_count = user_count + (new.author_role = 'user'),
+                   assistant_count = assistant_count + (new.author_role = 'assistant'),
+                   bytes = bytes + COALESCE((SELECT size FROM message_bodies WHERE body_id = new.body_id), 0)
+               WHERE conversation_id = new.conversation_id;
+               UPDATE conversation_stats SET
+                   first_ts = (SELECT MIN(create_ts) FROM messages WHERE conversation_id = conversation_stats.conversation_id AND create_ts > 0),
+                   last_ts = (SELECT MAX(create_ts) FROM messages WHERE conversation_id = conversation_stats.conversation_id AND create_ts > 0)
+               WHERE conversation_id IN (old.conversation_id, new.conversation_id);
+               DELETE FROM message_bodies WHERE body_id = old.body_id AND old.body_id IS NOT new.body_id
+                   AND NOT EXISTS (SELECT 1 FROM messages WHERE body_id = old.body_id);
+           END''',
+        'ANALYZE',
+    ]),
+    (9, "保存对话树（父消息）和当前分支", [
+        # 完整导出的 mapping 是一棵树，编辑或重新生成的回复是同一父消息下的兄弟节点。
+        # 按 parent_id 建索引以便查找子消息；current_node 是导出时正在查看的分支的叶子
+        '''CREATE TABLE message_parents (
+               message_id TEXT PRIMARY KEY,
+               parent_id TEXT
+           ) WITHOUT ROWID''',
+        'CREATE INDEX idx_message_parents_parent ON message_parents (parent_id)',
+        'ALTER TABLE conversations ADD COLUMN current_node TEXT',
+        '''CREATE TRIGGER messages_parent_delete AFTER DELETE ON messages BEGIN
+               DELETE FROM message_parents WHERE message_id = old.message_id;
+           END''',
+    ]),
+    (10, "添加消息渲染结果缓存表", [
+        # 按正文哈希保存 Markdown 渲染结果，renderer_version 与 RENDERER_VERSION 不同的行视为失效
+        '''CREATE TABLE rendered_html (
+               body_hash BLOB PRIMARY KEY,
+               renderer_version INTEGER NOT NULL,
+               html TEXT NOT NULL
+           ) WITHOUT ROWID''',
+        '''CREATE TRIGGER message_bodies_rendered_delete AFTER DELETE ON message_bodies BEGIN
+               DELETE FROM rendered_html WHERE body_hash = old.body_hash;
+           END''',
+    ]),
+    (11, "新正文的全文索引改由写入时批量分词", [
+        # 触发器对每一行调用一次 fts_segment，占了导入写入时间的大部分；
+        # 改为在 store_message_bodies 中对整批新正文分词后 executemany 写入。删除正文仍由触发器处理
+        'DROP TRIGGER IF EXISTS message_bodies_fts_insert',
+        # 在版本 7 合并之前升级的数据库索引已经完整，只需要建立空的补建记录表
+        '''CREATE TABLE IF NOT EXISTS fts_backfill (
+               next_body_id INTEGER NOT NULL,
+               last_body_id INTEGER NOT NULL
+           )''',
+        'DROP TRIGGER IF EXISTS message_bodies_fts_delete',
+        '''CREATE TRIGGER message_bodies_fts_delete AFTER DELETE ON message_bodies
+           WHEN NOT EXISTS (SELECT 1 FROM fts_backfill WHERE old.body_id BETWEEN next_body_id AND last_body_id) BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.body_id, fts_segment(old.content));
+           END''',
+    ]),
+    (12, "记录完整导出和压缩包中包含的会话", [
+        # 完整导出和压缩包的导入记录 conversation_id 为空，按文件哈希记下其中每个会话，
+        # 删除其中任一会话时连同整个文件的导入记录一起删除，之后可以重新导入
+        '''CREATE TABLE import_ledger_conversations (
+               content_hash TEXT NOT NULL,
+               conversation_id TEXT NOT NULL,
+               PRIMARY KEY (content_hash, conversation_id)
+           ) WITHOUT ROWID''',
+        '''CREATE INDEX idx_import_ledger_conversations_conversation
+           ON import_ledger_conversations (conversation_id)''',
+        '''CREATE TRIGGER import_ledger_delete AFTER DELETE ON import_ledger BEGIN
+               DELETE FROM import_ledger_conversations WHERE content_hash = old.content_hash;
+           END''',
+    ]),
+]
+
+def migrate_db(conn, on_migration=None):
+    """把数据库升级到最新版本，每个迁移在单独的事务中执行。
+
+    on_migration(description) 在每个迁移开始前调用，用于在界面上显示升级进度。
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for target_version, description, statements in MIGRATIONS:
+        if target_version <= version:
+            continue
+        if on_migration and statements:
+            on_migration(description)
+        try:
+            conn.execute('BEGIN')
+            for statement in statements:
+                conn.execute(statement)
+            # user_version 随事务一起提交，迁移失败时不会留下半升级的版本号
+            conn.execute(f'PRAGMA user_version = {target_version}')
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            raise sqlite3.Error(f"迁移到版本 {target_version}（{description}）失败: {e}") from e
+        version = target_version
+
 # ====================== Markdown初始化 ======================
-md = MarkdownIt().use(dollarmath_plugin).use(amsmath_plugin).use(deflist_plugin).use(tasklists_plugin)
+def create_markdown_renderer():
+    """创建 Markdown 渲染器。后台预取线程各自使用一个，不与界面线程共用。"""
+    return MarkdownIt().use(dollarmath_plugin).use(amsmath_plugin).use(deflist_plugin).use(tasklists_plugin)
+
+md = create_markdown_renderer()
+
+# ====================== 渲染缓存 ======================
+# Markdown 渲染方式（插件、选项）变化时加 1，已缓存的旧渲染结果随之失效
+RENDERER_VERSION = 1
+
+class RenderCache:
+    """消息正文 Markdown 渲染结果的缓存。
+
+    键是正文哈希（message_bodies.body_hash）：正文按内容寻址，哈希相同则渲染结果相同，
+    重复的正文只渲染一次。内存中按 UTF-8 编码后的字节数做 LRU 淘汰，未命中时再查 rendered_html 表；
+    新的渲染结果先留在内存中，由 flush() 批量写入数据库，界面线程不等待写锁。
+    """
+
+    def __init__(self, memory_budget=64 * 1024 * 1024):
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()  # body_hash -> (html, 字节数)，最近使用的在末尾
+        self.memory_bytes = 0
+        self.pending = {}  # 尚未写入数据库的渲染结果
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.renders = 0
+
+    def configure(self, config):
+        with self.lock:
+            self.memory_budget = config["render_cache_memory_mb"] * 1024 * 1024
+            self._evict()
+
+    def get_many(self, cursor, body_hashes):
+        """返回 {body_hash: html}，只包含已缓存的正文。"""
+        found = {}
+        missing = []
+        with self.lock:
+            for body_hash in set(body_hashes):
+                if body_hash in self.entries:
+                    self.entries.move_to_end(body_hash)
+                    found[body_hash] = self.entries[body_hash][0]
+                else:
+                    missing.append(body_hash)
+            self.memory_hits += len(found)
+        if missing:
+            rows = select_in_chunks(
+                cursor, f'SELECT body_hash, html FROM rendered_html WHERE renderer_version = {RENDERER_VERSION} AND body_hash IN ({{}})',
+                missing)
+            with self.lock:
+                for body_hash, content_html in rows:
+                    found[body_hash] = content_html
+                    self._remember(body_hash, content_html)
+                self.database_hits += len(rows)
+        return found
+
+    def put(self, body_hash, content_html):
+        """保存新的渲染结果，之后由 flush() 写入数据库。"""
+        with self.lock:
+            self._remember(body_hash, content_html)
+            self.pending[body_hash] = content_html
+            self.renders += 1
+
+    def flush(self, manager):
+        """把尚未保存的渲染结果写入 rendered_html 表。"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            with manager.writer() as conn:
+                conn.executemany('INSERT OR REPLACE INTO rendered_html (body_hash, renderer_version, html) VALUES (?, ?, ?)',
+                                 [(body_hash, RENDERER_VERSION, content_html) for body_hash, content_html in pending.items()])
+                conn.commit()
+        except sqlite3.Error:
+            pass  # 缓存写入失败不影响显示，下次打开时重新渲染
+
+    def _remember(self, body_hash, content_html):
+        if body_hash in self.entries:
+            self.memory_bytes -= self.entries.pop(body_hash)[1]
+        # len(str) 是字符数，中文正文按 UTF-8 计算约为 3 倍，预算按字节计
+        size = len(content_html.encode('utf-8'))
+        self.entries[body_hash] = (content_html, size)
+        self.memory_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.memory_bytes > self.memory_budget and self.entries:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.memory_bytes -= size
+
+render_cache = RenderCache()
 
 # ====================== 全局变量 ======================
-current_html_content = ""
+db = None  # 数据库连接管理器，写操作和后台线程的读操作都通过它取得连接
+conn = None  # 界面线程使用的只读连接
+current_html_content = ""  # 文档中已显示的各页消息的HTML
 messages_per_page = 10  # 每页显示的消息数量
-current_page = 0  # 当前页索引
+# 文档中已显示的各页，按显示顺序排列：[(page_id, html, first, last, message_count)]。
+# first/last 是页首尾消息的位置，翻页时从这里定位：按时间分页时是排序键 (create_ts, rowid)，
+# 沿分支分页时是分支上的下标范围 [first, last)
+loaded_pages = []
+# 按时间分页时，文档中第一条消息在会话中的序号。翻页时按页的消息数增减，只在跳转时才需要计数
+window_first_index = 0
+page_serial = 0  # 用于生成每页元素的 id
+MESSAGE_WINDOW_PAGES = 5  # 文档中最多保留的页数，超出时淘汰另一端的页，需要时再从渲染缓存重建
+conversation_scroll_job = None  # 拖动会话滚动条时等待执行的跳转
+# 有对话树的会话当前显示的分支（从根到叶的消息ID列表）
+active_path = None
+BRANCH_PATH_MAX_DEPTH = 100000  # 沿对话树查找时的最大深度，防止数据中的环导致无限递归
 conversation_collapsed = False  # 是否折叠会话列表
 selected_conversation_id = None  # 当前选中的会话ID
 search_query = ""  # 搜索查询
+search_mode = "name"  # 搜索方式："name" 按会话名称，"content" 按消息内容全文搜索
+conversation_sort = "imported"  # 会话列表排序方式，取值见 CONVERSATION_SORT_ORDERS
 is_dark_mode = False  # 是否启用深色模式
 # 正则表达式模式，用于匹配默认未命名的会话名称格式
 default_name_pattern = r"^messages-[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
 
-# ====================== 导入JSON文件 ======================
-def import_json(file_path, conn, selected_conversation_id=None, suppress_prompts=False):
-    """导入单个JSON文件到数据库。"""
+# ====================== 流式JSON解析 ======================
+def open_json_source(source):
+    """打开JSON数据源。source 可以是文件路径，也可以是返回二进制文件对象的函数（如压缩包成员）。"""
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, 'rb')
+    return source()
+
+def read_conversation_id(source):
+    """流式读取JSON文件中的 conversation_id，不把整个文件载入内存。"""
+    with open_json_source(source) as f:
+        if ijson is None:
+            return json.load(f).get("conversation_id", None)
+        for conversation_id in ijson.items(f, 'conversation_id'):
+            return conversation_id
+    return None
+
+def iter_json_messages(source):
+    """逐条产出JSON文件中 messages 数组的消息，内存占用与文件大小无关。"""
+    with open_json_source(source) as f:
+        if ijson is None:
+            # 未安装 ijson 时退回到一次性解析
+            yield from json.load(f).get('messages', [])
+            return
+        yield from ijson.items(f, 'messages.item', use_float=True)
+
+def detect_json_format(source):
+    """根据第一个非空白字符区分分享文件（对象）和完整导出的 conversations.json（数组）。"""
+    with open_json_source(source) as f:
+        while True:
+            chunk = f.read(4096)
+            if not chunk:
+                return None
+            json_format = json_format_from_head(chunk)
+            if json_format:
+                return json_format
+
+def json_format_from_head(head):
+    """根据开头的字节判断JSON格式，只有空白时返回 None。"""
+    head = head.lstrip(b' \t\r\n\xef\xbb\xbf')  # 同时去掉 UTF-8 BOM
+    if not head:
+        return None
+    return 'export' if head[:1] == b'[' else 'share'
+
+def iter_export_conversations(source):
+    """逐个产出完整导出文件中的会话，内存中同时只保留一个会话。"""
+    with open_json_source(source) as f:
+        if ijson is None:
+            yield from json.load(f)
+            return
+        yield from ijson.items(f, 'item', use_float=True)
+
+def iter_mapping_messages(conversation):
+    """按对话树顺序（深度优先，子节点保持原有顺序）产出 mapping 中的消息。"""
+    mapping = conversation.get('mapping') or {}
+    roots = [node_id for node_id, node in mapping.items() if node.get('parent') not in mapping]
+    stack = roots[::-1]
+    visited = set()
+    while stack:
+        node_id = stack.pop()
+        if node_id in visited:
+            continue
+        visited.add(node_id)
+        node = mapping[node_id]
+        message = node.get('message')
+        if is_visible_message(message):
+            yield message
+        stack.extend(child for child in reversed(node.get('children') or []) if child in mapping)
+
+def is_visible_message(message):
+    """跳过空的根节点和内容为空的系统消息。"""
+    return bool(message) and not (message.get('author', {}).get('role') == 'system'
+                                  and not any(message.get('content', {}).get('parts') or []))
+
+def mapping_parent_links(conversation):
+    """从 mapping 中取出对话树的父子关系，返回 ([(message_id, parent_id)], current_message_id)。
+
+    被跳过的节点（空的根节点、空的系统消息）不入库，它们的子消息挂到最近的可见祖先上；
+    current_node 同样换成最近的可见节点。
+    """
+    mapping = conversation.get('mapping') or {}
+    visible = {node_id: node['message'].get('id') for node_id, node in mapping.items()
+               if is_visible_message(node.get('message')) and node['message'].get('id')}
+
+    def nearest_visible(node_id):
+        seen = set()
+        while node_id in mapping and node_id not in visible and node_id not in seen:
+            seen.add(node_id)
+            node_id = mapping[node_id].get('parent')
+        return visible.get(node_id)
+
+    links = [(message_id, nearest_visible(mapping[node_id].get('parent'))) for node_id, message_id in visible.items()]
+    return links, nearest_visible(conversation.get('current_node'))
+
+def format_timestamp(timestamp):
+    """把纪元秒数格式化为本地时间的显示文本，时间未知（<= 0）或无效时返回 None。"""
+    if timestamp <= 0:
+        return None
     try:
-        root.config(cursor="wait")
-        root.update_idletasks()
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    except (OverflowError, OSError, ValueError):
+        return None
+
+def message_to_row(message, conversation_id):
+    """将一条消息转换为 messages 表的一行。
+
+    行的列顺序为 (message_id, conversation_id, author_role, content,
+    create_time, create_ts, create_display)，时间在导入时解析一次，显示时不再解析。
+    """
+    message_id = message.get('id')
+    author_role = message.get('author', {}).get('role', '')
+    content_parts = message.get('content', {}).get('parts', [])
+    content = "\n".join([str(part) if isinstance(part, str) else "[Non-text content]" for part in content_parts])
+    create_time = message.get('create_time', '')
+    try:
+        create_ts = float(create_time)
+    except (TypeError, ValueError):
+        create_ts = 0.0
+    if not 0 < create_ts < float('inf'):
+        create_ts = 0.0
+    return (message_id, conversation_id, author_role, content, str(create_time), create_ts, format_timestamp(create_ts))
+
+# ====================== 压缩包读取 ======================
+# 单个压缩的JSON文件只认 .json.gz 这样的双后缀，其他 .gz/.xz 文件（日志、备份等）不是会话
+COMPRESSED_JSON_SUFFIXES = ('.json.gz', '.json.bz2', '.json.xz', '.json.zst')
+TAR_SUFFIXES = ('.tar', '.tgz', '.tar.gz', '.tar.bz2', '.tar.xz', '.tar.zst')
+ARCHIVE_SUFFIXES = ('.zip',) + COMPRESSED_JSON_SUFFIXES + TAR_SUFFIXES
+
+# 完整导出压缩包中的会话文件。同一压缩包里的 shared_conversations.json、message_feedback.json
+# 等也是数组，条目带有 conversation_id 但不是会话，不能当作完整导出读取
+EXPORT_MEMBER_NAME = 'conversations.json'
+
+def is_archive(file_path):
+    """判断文件是否是支持直接导入的压缩包。"""
+    return file_path.lower().endswith(ARCHIVE_SUFFIXES)
+
+def is_export_member(member_name):
+    """压缩包中的数组格式成员只有 conversations.json 是完整导出的会话列表。"""
+    return os.path.basename(member_name).lower() == EXPORT_MEMBER_NAME
+
+def open_zstd(file_path):
+    """以流的方式打开 .zst 文件。"""
+    if zstandard is None:
+        raise RuntimeError("读取 .zst 文件需要安装 zstandard")
+    return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+
+def iter_archive_members(file_path):
+    """逐个产出压缩包中的JSON成员 (member_name, json_format, source)，成员内容直接从压缩流读取，不写入磁盘。
+
+    source 可以传给 open_json_source。zip 和单文件 .gz/.bz2/.xz/.zst 可以反复打开；
+    tar 只能顺序读一遍，其中的完整导出成员保持流式，分享文件成员
+    （单个会话，体积很小）读入内存以便两遍解析。
+    """
+    lower = file_path.lower()
+    if lower.endswith('.zip'):
+        with zipfile.ZipFile(file_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith('.json'):
+                    source = lambda info=info: archive.open(info)
+                    json_format = detect_json_format(source)
+                    if json_format == 'export' and not is_export_member(info.filename):
+                        continue
+                    yield info.filename, json_format, source
+        return
+    if lower.endswith(TAR_SUFFIXES):
+        if lower.endswith('.tar.zst'):
+            tar = tarfile.open(fileobj=open_zstd(file_path), mode='r|')
+        else:
+            tar = tarfile.open(file_path, mode='r|*')
+        with tar:
+            for member in tar:
+                if not member.isfile() or not member.name.lower().endswith('.json'):
+                    continue
+                stream = tar.extractfile(member)
+                json_format = json_format_from_head(stream.peek(4096)) or 'share'
+                if json_format == 'export' and not is_export_member(member.name):
+                    continue
+                if json_format == 'export':
+                    yield member.name, json_format, lambda stream=stream: stream
+                else:
+                    data = stream.read()
+                    yield member.name, json_format, lambda data=data: io.BytesIO(data)
+        return
+    # 单个压缩的JSON文件，如 conversations.json.gz
+    member_name = os.path.splitext(os.path.basename(file_path))[0]
+    if lower.endswith('.gz'):
+        source = lambda: gzip.open(file_path, 'rb')
+    elif lower.endswith('.bz2'):
+        source = lambda: bz2.open(file_path, 'rb')
+    elif lower.endswith('.xz'):
+        source = lambda: lzma.open(file_path, 'rb')
+    else:
+        source = lambda: open_zstd(file_path)
+    yield member_name, detect_json_format(source), source
+
+# ====================== 消息内容压缩 ======================
+# 压缩后的内容以 BLOB 存储，第一个字节表示压缩方式；未压缩的内容仍是 TEXT
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2  # zstd 帧头中自带字典ID（0 表示不使用字典）
+ZSTD_DICTIONARY_SIZE = 112 * 1024
+ZSTD_DICTIONARY_MIN_SAMPLES = 100  # 样本太少时训练出的字典没有意义
+
+class ContentCodec:
+    """消息内容的透明压缩与解压。
+
+    写入时 encode() 只压缩超过阈值且压缩后确实变小的内容；读取时所有路径都通过
+    decode() 还原，未压缩的 TEXT 原样返回，因此压缩开关可以随时切换。
+    zstd 字典保存在 compression_dicts 表中，按帧头中的字典ID查找。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.threshold = DEFAULT_CONFIG["compression_threshold"]
+        self.codec = CODEC_ZLIB
+        self.dictionaries = {}  # dict_id -> zstandard.ZstdCompressionDict
+        self.current_dict_id = 0  # 压缩时使用的字典，0 表示不使用
+        self.local = threading.local()  # zstd 压缩/解压对象不能跨线程共用
+        # 解压耗时统计，用于压缩统计报告
+        self.decode_count = 0
+        self.decode_seconds = 0.0
+
+    def configure(self, config):
+        """按配置设置是否压缩、阈值和压缩方式。"""
+        self.enabled = config["compress_content"]
+        self.threshold = config["compression_threshold"]
+        self.codec = CODEC_ZSTD if config["compression_codec"] == "zstd" and zstandard else CODEC_ZLIB
+        self.local = threading.local()
+
+    def load_dictionaries(self, conn):
+        """从数据库载入所有 zstd 字典，最新的一个用于压缩。"""
+        if zstandard is None:
+            return
+        for dict_id, data in conn.execute('SELECT dict_id, dictionary FROM compression_dicts ORDER BY created_at').fetchall():
+            self.dictionaries[dict_id] = zstandard.ZstdCompressionDict(data)
+            self.current_dict_id = dict_id
+        self.local = threading.local()
+
+    def add_dictionary(self, dictionary):
+        self.dictionaries[dictionary.dict_id()] = dictionary
+        self.current_dict_id = dictionary.dict_id()
+        self.local = threading.local()
+
+    def _compressor(self):
+        compressor = getattr(self.local, 'compressor', None)
+        if compressor is None:
+            dictionary = self.dictionaries.get(self.current_dict_id)
+            compressor = zstandard.ZstdCompressor(level=3, dict_data=dictionary) if dictionary else zstandard.ZstdCompressor(level=3)
+            self.local.compressor = compressor
+        return compressor
+
+    def _decompressor(self, dict_id):
+        decompressors = getattr(self.local, 'decompressors', None)
+        if decompressors is None:
+            decompressors = self.local.decompressors = {}
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id:
+                decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionaries[dict_id])
+            else:
+                decompressor = zstandard.ZstdDecompressor()
+            decompressors[dict_id] = decompressor
+        return decompressor
+
+    def encode(self, text):
+        """按需压缩消息内容，返回 TEXT 或压缩后的 BLOB。"""
+        if not text or not self.enabled:
+            return text
+        data = text.encode('utf-8')
+        if len(data) < self.threshold:
+            return text
+        if self.codec == CODEC_ZSTD:
+            compressed = bytes([CODEC_ZSTD]) + self._compressor().compress(data)
+        else:
+            compressed = bytes([CODEC_ZLIB]) + zlib.compress(data, 6)
+        return compressed if len(compressed) < len(data) else text
+
+    def decode(self, value):
+        """还原消息内容：TEXT 原样返回，压缩的 BLOB 解压为 TEXT。"""
+        if not isinstance(value, bytes):
+            return value
+        start = time.perf_counter()
+        codec, data = value[0], value[1:]
+        if codec == CODEC_ZLIB:
+            text = zlib.decompress(data).decode('utf-8')
+        elif codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("读取压缩的消息内容需要安装 zstandard")
+            dict_id = zstandard.get_frame_parameters(data).dict_id
+            text = self._decompressor(dict_id).decompress(data).decode('utf-8')
+        else:
+            text = value.decode('utf-8', errors='replace')
+        self.decode_count += 1
+        self.decode_seconds += time.perf_counter() - start
+        return text
+
+content_codec = ContentCodec()
+
+def encode_content(text):
+    return content_codec.encode(text)
+
+def decode_content(value):
+    return content_codec.decode(value)
+
+def train_content_dictionary(conn, sample_limit=5000):
+    """用库中较长的消息正文训练 zstd 字典并保存，返回字典；样本不足或未安装 zstandard 时返回 None。"""
+    if zstandard is None:
+        return None
+    samples = []
+    for (content,) in conn.execute('''
+        SELECT content FROM message_bodies WHERE size >= ?
+        ORDER BY random() LIMIT ?
+    ''', (max(content_codec.threshold, 64), sample_limit)):
+        samples.append(decode_content(content).encode('utf-8'))
+    if len(samples) < ZSTD_DICTIONARY_MIN_SAMPLES:
+        return None
+    dictionary = zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, samples)
+    conn.execute('INSERT OR REPLACE INTO compression_dicts (dict_id, dictionary, sample_count, created_at) VALUES (?, ?, ?, ?)',
+                 (dictionary.dict_id(), dictionary.as_bytes(), len(samples), datetime.now().isoformat(timespec='seconds')))
+    conn.commit()
+    content_codec.add_dictionary(dictionary)
+    return dictionary
+
+def recompress_messages(manager, on_progress=None, batch_size=500):
+    """按当前设置重写所有消息正文（按 body_id 分批，每批一个短事务），返回节省的字节数。
+
+    关闭压缩时会把已压缩的正文还原为原文。正文的原文不变，全文索引无需更新；
+    完成后执行 VACUUM 回收空间。
+    """
+    saved = 0
+    last_body_id = 0
+    processed = 0
+    with manager.reader() as read_conn:
+        total = read_conn.execute('SELECT COUNT(*) FROM message_bodies').fetchone()[0]
+    while True:
+        with manager.writer() as conn:
+            rows = conn.execute('''
+                SELECT body_id, content FROM message_bodies WHERE body_id > ? ORDER BY body_id LIMIT ?
+            ''', (last_body_id, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for body_id, content in rows:
+                encoded = encode_content(decode_content(content))
+                if encoded != content:
+                    old_size = len(content) if isinstance(content, bytes) else len(content.encode('utf-8'))
+                    new_size = len(encoded) if isinstance(encoded, bytes) else len(encoded.encode('utf-8'))
+                    saved += old_size - new_size
+                    updates.append((encoded, body_id))
+            conn.executemany('UPDATE message_bodies SET content=? WHERE body_id=?', updates)
+            conn.commit()
+        last_body_id = rows[-1][0]
+        processed += len(rows)
+        if on_progress:
+            on_progress(processed, total)
+    with manager.writer() as conn:
+        conn.execute('VACUUM')
+    return saved
+
+def compression_report(conn, messages_per_view, sample_limit=2000):
+    """统计去重和压缩节省的空间，并抽样测量解压的平均耗时。"""
+    message_count, referenced_bytes = conn.execute('''
+        SELECT COUNT(*), COALESCE(SUM(b.size), 0) FROM messages m JOIN message_bodies b ON b.body_id = m.body_id
+    ''').fetchone()
+    body_count, compressed_count, plain_bytes, stored_bytes = conn.execute('''
+        SELECT COUNT(*), COALESCE(SUM(typeof(content) = 'blob'), 0), COALESCE(SUM(size), 0),
+               COALESCE(SUM(length(CAST(content AS BLOB))), 0)
+        FROM message_bodies
+    ''').fetchone()
+    samples = [content for (content,) in conn.execute(
+        "SELECT content FROM message_bodies WHERE typeof(content) = 'blob' ORDER BY random() LIMIT ?", (sample_limit,))]
+    start = time.perf_counter()
+    for content in samples:
+        decode_content(content)
+    per_message_ms = (time.perf_counter() - start) * 1000 / len(samples) if samples else 0.0
+    megabytes = lambda size: f"{size / 1024 / 1024:.1f} MB"
+    lines = [
+        f"消息: {message_count} 条，引用 {body_count} 份不同的正文",
+        f"去重: 正文总量 {megabytes(referenced_bytes)}，去重后 {megabytes(plain_bytes)}，"
+        f"节省 {megabytes(referenced_bytes - plain_bytes)}",
+        f"压缩: {compressed_count} 份正文已压缩，{megabytes(plain_bytes)} 实际存储 {megabytes(stored_bytes)}，"
+        f"节省 {megabytes(plain_bytes - stored_bytes)}",
+        f"解压耗时: 平均每份压缩正文 {per_message_ms:.3f} ms，每页（{messages_per_view} 条）最多约 {per_message_ms * messages_per_view:.2f} ms",
+    ]
+    if content_codec.decode_count:
+        lines.append(f"本次运行已解压 {content_codec.decode_count} 条，平均 {content_codec.decode_seconds * 1000 / content_codec.decode_count:.3f} ms/条")
+    return "\n".join(lines)
+
+def show_compression_report():
+    """显示去重和压缩的存储统计。"""
+    try:
+        with db.reader() as read_conn:
+            messagebox.showinfo("存储统计", compression_report(read_conn, messages_per_page))
+    except sqlite3.Error as e:
+        messagebox.showerror("错误", f"统计失败: {e}")
+
+def start_recompress_messages():
+    """在后台线程中训练字典（使用 zstd 时）并按当前设置重写现有消息。"""
+    if current_import:
+        messagebox.showinfo("提示", "已有导入任务正在进行，请稍后再试。")
+        return
+    if not messagebox.askyesno("压缩现有消息", "将按当前压缩设置重写所有消息并整理数据库文件，可能需要较长时间。是否继续？"):
+        return
+
+    def on_progress(processed, total):
+        root.after(0, status_var.set, f"正在压缩消息: {processed}/{total}")
+
+    def worker():
+        try:
+            if content_codec.enabled and content_codec.codec == CODEC_ZSTD:
+                with db.writer() as conn:
+                    train_content_dictionary(conn)
+            saved = recompress_messages(db, on_progress)
+            root.after(0, status_var.set, f"压缩完成，节省 {saved / 1024 / 1024:.1f} MB")
+        except (sqlite3.Error, RuntimeError) as e:
+            root.after(0, lambda msg=str(e): messagebox.showerror("压缩失败", msg))
+
+    threading.Thread(target=worker, daemon=True).start()
+
+# ====================== 批量写入 ======================
+def ensure_conversation(cursor, conversation_id, conversation_name):
+    """会话不存在时创建会话记录，返回会话此前是否已存在。"""
+    cursor.execute('SELECT conversation_id FROM conversations WHERE conversation_id=?', (conversation_id,))
+    if cursor.fetchone():
+        return True
+    cursor.execute('''
+        INSERT OR REPLACE INTO conversations (conversation_id, conversation_name)
+        VALUES (?, ?)
+    ''', (conversation_id, conversation_name))
+    return False
+
+def content_body_hash(text):
+    """消息正文的内容哈希：按原文 UTF-8 编码计算的 SHA-256 摘要。"""
+    return hashlib.sha256((text or '').encode('utf-8')).digest()
+
+def select_in_chunks(cursor, query, values, chunk_size=500):
+    """执行带 IN (...) 条件的查询，参数过多时分块执行，返回所有结果行。query 中用 {} 表示占位符列表。"""
+    results = []
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        cursor.execute(query.format(','.join('?' * len(chunk))), chunk)
+        results.extend(cursor.fetchall())
+    return results
+
+def store_message_bodies(cursor, texts, hashes):
+    """把消息正文写入 message_bodies，已存在的正文只引用不重复写入，返回与 texts 一一对应的 body_id。"""
+    unique_hashes = list(dict.fromkeys(hashes))
+    body_ids = dict(select_in_chunks(cursor, 'SELECT body_hash, body_id FROM message_bodies WHERE body_hash IN ({})', unique_hashes))
+    missing = {}
+    for body_hash, text in zip(hashes, texts):
+        if body_hash not in body_ids and body_hash not in missing:
+            missing[body_hash] = text or ''
+    if missing:
+        # 只有新正文才需要压缩
+        cursor.executemany('INSERT INTO message_bodies (body_hash, content, size) VALUES (?, ?, ?)',
+                           [(body_hash, encode_content(text), len(text.encode('utf-8'))) for body_hash, text in missing.items()])
+        body_ids.update(select_in_chunks(cursor, 'SELECT body_hash, body_id FROM message_bodies WHERE body_hash IN ({})', list(missing)))
+        # 原文已经在内存中，在这里分词后批量写入全文索引，不在触发器中逐行调用 Python 函数
+        cursor.executemany('INSERT INTO messages_fts (rowid, content) VALUES (?, ?)',
+                           [(body_ids[body_hash], fts_segment(text)) for body_hash, text in missing.items()])
+    return [body_ids[body_hash] for body_hash in hashes]
+
+def link_message_rows(cursor, rows, hashes=None):
+    """把消息行 (message_id, conversation_id, author_role, content, ...) 中的 content 换成 body_id。"""
+    if hashes is None:
+        hashes = [content_body_hash(row[3]) for row in rows]
+    body_ids = store_message_bodies(cursor, [row[3] for row in rows], hashes)
+    return [tuple(row[:3]) + (body_id,) + tuple(row[4:]) for row, body_id in zip(rows, body_ids)]
+
+def insert_message_rows(cursor, rows, batch_size, on_progress=None):
+    """按批使用 executemany 写入消息行，返回写入的行数。
+
+    正文按内容哈希去重后存入 message_bodies，messages 只保存 body_id。
+    已存在的消息原地更新而不是 INSERT OR REPLACE 删除重建，触发器据此清理不再被引用的正文。
+    """
+    rows = iter(rows)
+    row_count = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        cursor.executemany('''
+            INSERT INTO messages (message_id, conversation_id, author_role, body_id, create_time, create_ts, create_display)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (message_id) DO UPDATE SET
+                conversation_id=excluded.conversation_id, author_role=excluded.author_role,
+                body_id=excluded.body_id, create_time=excluded.create_time,
+                create_ts=excluded.create_ts, create_display=excluded.create_display
+        ''', link_message_rows(cursor, batch))
+        row_count += len(batch)
+        if on_progress:
+            on_progress(row_count)
+    return row_count
+
+def store_message_tree(cursor, conversation_id, links, current_node):
+    """保存会话的父子关系和当前分支的叶子消息。current_node 为 None 时保留原有的当前分支。"""
+    cursor.executemany('INSERT OR REPLACE INTO message_parents (message_id, parent_id) VALUES (?, ?)', links)
+    cursor.execute('UPDATE conversations SET current_node=COALESCE(?, current_node) WHERE conversation_id=?',
+                   (current_node, conversation_id))
+
+def insert_new_message_rows(cursor, conversation_id, rows, batch_size, on_progress=None):
+    """追加模式：只写入会话中尚不存在的消息，内容有变化的消息原地更新。
+
+    先读出会话已有消息的字段和正文哈希，比较时不需要读取和解压正文；未变化的
+    消息不做任何写操作，也不会删除重建整行。
+    返回 {"new": 新增条数, "unchanged": 未变条数, "changed": 更新条数}。
+    """
+    cursor.execute('''
+        SELECT m.message_id, m.author_role, b.body_hash, m.create_time, m.create_ts, m.create_display
+        FROM messages m JOIN message_bodies b ON b.body_id = m.body_id
+        WHERE m.conversation_id=?
+    ''', (conversation_id,))
+    stored = {row[0]: row[1:] for row in cursor.fetchall()}
+    stats = {"new": 0, "unchanged": 0, "changed": 0}
+    rows = iter(rows)
+    row_count = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        new_rows = []
+        changed_rows = []
+        for row in batch:
+            body_hash = content_body_hash(row[3])
+            stored_row = stored.get(row[0])
+            if stored_row is None:
+                new_rows.append((row, body_hash))
+            elif stored_row == (row[2], body_hash) + tuple(row[4:]):
+                stats["unchanged"] += 1
+            else:
+                changed_rows.append((row, body_hash))
+        if new_rows:
+            # 消息ID已存在于其他会话中的行视为未变化，也不为它们写入正文
+            existing = {message_id for (message_id,) in select_in_chunks(
+                cursor, 'SELECT message_id FROM messages WHERE message_id IN ({})', [row[0] for row, _ in new_rows])}
+            stats["unchanged"] += len(existing)
+            new_rows = [(row, body_hash) for row, body_hash in new_rows if row[0] not in existing]
+            cursor.executemany('''
+                INSERT OR IGNORE INTO messages (message_id, conversation_id, author_role, body_id, create_time, create_ts, create_display)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', link_message_rows(cursor, [row for row, _ in new_rows], [body_hash for _, body_hash in new_rows]))
+            stats["new"] += len(new_rows)
+        if changed_rows:
+            linked = link_message_rows(cursor, [row for row, _ in changed_rows], [body_hash for _, body_hash in changed_rows])
+            cursor.executemany('''
+                UPDATE messages SET author_role=?, body_id=?, create_time=?, create_ts=?, create_display=?
+                WHERE message_id=?
+            ''', [tuple(row[2:]) + (row[0],) for row in linked])
+            stats["changed"] += len(changed_rows)
+        row_count += len(batch)
+        if on_progress:
+            on_progress(row_count)
+    return stats
+
+@contextmanager
+def bulk_load_mode(manager, enabled=True):
+    """批量导入期间临时关闭写连接的同步写盘，结束后恢复原设置。
+
+    WAL 模式下保持 WAL 不变（否则读连接会被阻塞），关闭同步只可能在断电时丢失最近的提交；
+    数据库不是 WAL 模式时同时改用内存日志。
+    """
+    if not enabled:
+        yield
+        return
+    with manager.writer() as conn:
+        conn.commit()  # journal_mode 不能在事务中修改
+        synchronous = conn.execute('PRAGMA synchronous').fetchall()[0][0]
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchall()[0][0]
+        conn.execute('PRAGMA synchronous=OFF')
+        if journal_mode != 'wal':
+            conn.execute('PRAGMA journal_mode=MEMORY').fetchall()
+    try:
+        yield
+    finally:
+        with manager.writer() as conn:
+            # 正常结束时数据已提交，此处未提交的内容说明导入中途出错
+            if conn.in_transaction:
+                conn.rollback()
+            if journal_mode != 'wal':
+                conn.execute(f'PRAGMA journal_mode={journal_mode}').fetchall()
+            conn.execute(f'PRAGMA synchronous={synchronous}')
+
+# ====================== 导入记录 ======================
+ALREADY_IMPORTED = "already_imported"  # 解析结果占位：文件已在导入记录中，无需再写入
+EXPORT_FILE = "export_file"  # 解析结果占位：完整导出文件，由写入线程逐个会话流式写入
+ARCHIVE_FILE = "archive_file"  # 解析结果占位：压缩包，由写入线程逐个成员流式写入
+
+def file_content_hash(file_path):
+    """流式计算文件内容的 SHA-256。"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def find_import_record_by_stat(cursor, file_path, file_stat):
+    """只按文件名/大小/修改时间查找导入记录，不读取文件内容，可以在界面线程中调用。"""
+    cursor.execute('''
+        SELECT conversation_id, message_count, imported_at FROM import_ledger
+        WHERE file_name=? AND file_size=? AND file_mtime=?
+    ''', (os.path.basename(file_path), file_stat.st_size, file_stat.st_mtime))
+    return cursor.fetchone()
+
+def find_import_record(cursor, file_path, file_stat, content_hash=None):
+    """在导入记录中查找文件，先比较文件名/大小/修改时间，再比较内容哈希。
+
+    返回 (record, content_hash)，record 为 (conversation_id, message_count, imported_at) 或 None。
+    只有大小和修改时间未命中时才会计算哈希，因此应在后台线程中调用。
+    """
+    record = find_import_record_by_stat(cursor, file_path, file_stat)
+    if record:
+        return record, content_hash
+    content_hash = content_hash or file_content_hash(file_path)
+    cursor.execute('''
+        SELECT conversation_id, message_count, imported_at FROM import_ledger WHERE content_hash=?
+    ''', (content_hash,))
+    return cursor.fetchone(), content_hash
+
+def record_import(cursor, file_path, file_stat, content_hash, conversation_id, message_count, conversation_ids=()):
+    """记录一个已成功导入的文件。
+
+    包含多个会话的文件 conversation_id 为 None，其中的会话通过 conversation_ids 记录。
+    """
+    cursor.execute('''
+        INSERT OR REPLACE INTO import_ledger
+            (content_hash, file_name, file_size, file_mtime, conversation_id, message_count, imported_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (content_hash, os.path.basename(file_path), file_stat.st_size, file_stat.st_mtime,
+          conversation_id, message_count, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    # INSERT OR REPLACE 替换旧行时不会触发删除触发器，需要手动清掉旧的会话记录
+    cursor.execute('DELETE FROM import_ledger_conversations WHERE content_hash=?', (content_hash,))
+    cursor.executemany(
+        'INSERT OR IGNORE INTO import_ledger_conversations (content_hash, conversation_id) VALUES (?, ?)',
+        [(content_hash, cid) for cid in conversation_ids])
+
+# ====================== 并行解析/单线程写入流水线 ======================
+def parse_json_file(file_path):
+    """在子进程中解析JSON文件，返回会话ID和紧凑的消息行元组列表。"""
+    conversation_id = read_conversation_id(file_path)
+    if not conversation_id:
+        return None, []
+    return conversation_id, [message_to_row(message, conversation_id) for message in iter_json_messages(file_path)]
+
+def stream_json_file(source):
+    """在当前线程中流式解析JSON文件，消息行以生成器形式返回。"""
+    conversation_id = read_conversation_id(source)
+    if not conversation_id:
+        return None, iter(())
+    return conversation_id, (message_to_row(message, conversation_id) for message in iter_json_messages(source))
+
+class ImportPipeline:
+    """由进程池并行解析JSON文件、单个写入线程批量写入SQLite的导入流水线。
+
+    解析结果以 (file_path, parsed) 的形式进入队列，parsed 可以是
+    (conversation_id, rows)、None（大文件，由写入线程自行流式解析）、
+    EXPORT_FILE（完整导出文件，每个会话一个事务）、ARCHIVE_FILE（压缩包，
+    每个成员或会话一个事务）、ALREADY_IMPORTED
+    或解析时抛出的异常（该文件被跳过）。写入线程独占一个数据库连接，
+    多个文件合并到一个事务中，每个文件使用一个保存点。
+    调用 cancel() 后会在当前文件写完后停止，已提交的文件不受影响。
+
+    conversation_id/conversation_name 用于单文件导入时追加到指定会话
+    或使用用户输入的会话名称。use_ledger 为 True 时跳过导入记录中
+    已有的文件；无论是否跳过，成功写入的文件都会记入导入记录。
+    """
+
+    def __init__(self, file_paths, config, conversation_id=None, conversation_name=None, use_ledger=True):
+        self.file_paths = list(file_paths)
+        self.conversation_id = conversation_id
+        self.conversation_name = conversation_name
+        self.use_ledger = use_ledger
+        self.file_info = {}  # file_path -> (os.stat_result, content_hash)
+        self.batch_size = config["import_batch_size"]
+        self.files_per_transaction = config["import_files_per_transaction"]
+        self.bulk_mode = config["bulk_import_mode"]
+        self.stream_threshold = config["stream_file_threshold"]
+        self.workers = config["import_workers"] or os.cpu_count() or 1
+        self.parsed_queue = queue.Queue()
+        self.done_queue = queue.Queue()  # 已提交的文件，由调用方线程处理
+        self.cancel_event = threading.Event()
+        self.failed_files = []  # (file_path, exception)
+        self.error = None
+        self.holds_write_lock = False  # 写入线程当前是否持有连接管理器的写锁
+        self.transaction_start = 0.0
+        self.batch_checkpoint = None  # 写入单个文件期间，每批消息写完后调用，事务过长时中途提交
+        # 各阶段统计
+        self.start_time = None
+        self.parse_end_time = None
+        self.parsed_files = 0
+        self.parsed_rows = 0
+        self.processed_files = 0
+        self.skipped_files = 0
+        self.created_conversations = []  # 本次新建的会话ID
+        self.missing_id_files = []  # 找不到会话ID的分享文件
+        self.exported_conversations = 0  # 完整导出文件和压缩包中写入的会话数
+        self.file_conversations = []  # 当前多会话文件中已写入的会话ID
+        self.append_stats = {"new": 0, "unchanged": 0, "changed": 0}
+        self.written_files = 0
+        self.written_rows = 0
+        self.write_busy = 0.0
+
+    def run(self, on_tick=None):
+        """运行流水线直到所有文件写入完成，返回写入的消息总数。"""
+        self.start_time = time.perf_counter()
+        writer = threading.Thread(target=self._write_loop, daemon=True)
+        writer.start()
+        small_files = []
+        try:
+            with db.reader() as ledger_conn:
+                for file_path in self.file_paths:
+                    if self.cancel_event.is_set():
+                        break
+                    try:
+                        file_stat = os.stat(file_path)
+                        record = None
+                        content_hash = None
+                        if self.use_ledger:
+                            record, content_hash = find_import_record(ledger_conn.cursor(), file_path, file_stat)
+                        else:
+                            content_hash = file_content_hash(file_path)
+                        self.file_info[file_path] = (file_stat, content_hash)
+                        if record:
+                            # 已导入过且内容未变，不解析直接跳过
+                            parsed = ALREADY_IMPORTED
+                        elif is_archive(file_path):
+                            parsed = ARCHIVE_FILE
+                        elif detect_json_format(file_path) == 'export':
+                            parsed = EXPORT_FILE
+                        elif file_stat.st_size >= self.stream_threshold or len(self.file_paths) == 1:
+                            parsed = None
+                        else:
+                            small_files.append(file_path)
+                            continue
+                    except Exception as e:
+                        # 文件无法读取或已被移走，记为失败，继续处理其他文件
+                        parsed = e
+                    self.parsed_queue.put((file_path, parsed))
+            if len(small_files) == 1:
+                # 只有一个文件时启动进程池得不偿失
+                self.parsed_queue.put((small_files[0], None))
+            elif small_files:
+                self._parse_in_pool(small_files, writer, on_tick)
+            self.parse_end_time = time.perf_counter()
+        finally:
+            # 无论解析端是否出错，都让写入线程提交已写入的文件后退出，并等它恢复写连接的设置
+            self.parsed_queue.put(None)
+            while writer.is_alive():
+                writer.join(0.1)
+                if on_tick:
+                    on_tick()
+        if on_tick:
+            on_tick()
+        if self.error:
+            raise self.error
+        return self.written_rows
+
+    def _parse_in_pool(self, file_paths, writer, on_tick):
+        """用进程池解析文件，限制在途结果数量以控制内存。"""
+        workers = min(self.workers, len(file_paths))
+        max_in_flight = workers * 2
+        remaining = list(reversed(file_paths))
+        pending = {}
+        # 使用 spawn 避免在已有线程的进程中 fork
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            while (remaining or pending) and writer.is_alive():
+                if self.cancel_event.is_set():
+                    # 取消尚未开始的解析任务，只等待正在解析的文件
+                    for future in pending:
+                        future.cancel()
+                    break
+                while remaining and len(pending) + self.parsed_queue.qsize() < max_in_flight:
+                    file_path = remaining.pop()
+                    pending[pool.submit(parse_json_file, file_path)] = file_path
+                if not pending:
+                    # 写入线程跟不上，等待队列消化
+                    time.sleep(0.05)
+                    if on_tick:
+                        on_tick()
+                    continue
+                done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_path = pending.pop(future)
+                    try:
+                        parsed = future.result()
+                        self.parsed_rows += len(parsed[1])
+                    except Exception as e:
+                        parsed = e
+                    self.parsed_files += 1
+                    self.parsed_queue.put((file_path, parsed))
+                if on_tick:
+                    on_tick()
+
+    def _write_loop(self):
+        """写入线程：从队列取出解析结果并写入数据库。
+
+        使用连接管理器的共享写连接，只在事务期间持有写锁，
+        界面上的删除、重命名等写操作可以在两个事务之间进行。
+        """
+        conn = db.write_conn
         cursor = conn.cursor()
-        conversation_id = data.get("conversation_id", None)
-        if selected_conversation_id:
-            # 使用提供的会话ID追加消息
-            conversation_id = selected_conversation_id
-        if not conversation_id:
-            if not suppress_prompts:
-                messagebox.showerror("错误", "无法找到有效的会话ID。")
+        uncommitted = []
+        try:
+            with bulk_load_mode(db, self.bulk_mode):
+                while True:
+                    if self.parsed_queue.empty():
+                        # 等待解析结果时先提交，不在空闲时占着写锁
+                        self._commit(conn, uncommitted)
+                    item = self.parsed_queue.get()
+                    if item is None or self.cancel_event.is_set():
+                        break
+                    busy_start = time.perf_counter()
+                    file_path, parsed = item
+                    if parsed is EXPORT_FILE or parsed is ARCHIVE_FILE:
+                        # 完整导出文件和压缩包自行管理事务，先提交之前累积的文件
+                        self._commit(conn, uncommitted)
+                        if parsed is EXPORT_FILE:
+                            write = lambda: self._write_export(conn, cursor, file_path, file_path)
+                        else:
+                            write = lambda: self._write_archive(conn, cursor, file_path)
+                        if self._write_multi_conversation_file(conn, cursor, file_path, write):
+                            uncommitted.append(file_path)
+                        self.processed_files += 1
+                        self.write_busy += time.perf_counter() - busy_start
+                        continue
+                    if not conn.in_transaction:
+                        self._begin(cursor)
+                    cursor.execute('SAVEPOINT import_file')
+                    self.batch_checkpoint = lambda: self._checkpoint(conn, cursor, uncommitted)
+                    try:
+                        self._write_file(cursor, file_path, parsed)
+                        cursor.execute('RELEASE import_file')
+                    except Exception as e:
+                        # 只丢弃当前文件（中途提交之后）写入的内容，继续处理其他文件
+                        cursor.execute('ROLLBACK TO import_file')
+                        cursor.execute('RELEASE import_file')
+                        self.failed_files.append((file_path, e))
+                    finally:
+                        self.batch_checkpoint = None
+                    uncommitted.append(file_path)
+                    self.processed_files += 1
+                    if (len(uncommitted) >= self.files_per_transaction
+                            or time.perf_counter() - self.transaction_start >= WRITE_TRANSACTION_MAX_SECONDS):
+                        self._commit(conn, uncommitted)
+                    self.write_busy += time.perf_counter() - busy_start
+                self._commit(conn, uncommitted)
+        except sqlite3.Error as e:
+            self.error = e
+            # 让解析端不再等待队列空位
+            while not self.parsed_queue.empty():
+                self.parsed_queue.get_nowait()
+        finally:
+            self._rollback(conn)
+
+    def _write_file(self, cursor, file_path, parsed):
+        """写入单个文件的解析结果。"""
+        if isinstance(parsed, Exception):
+            raise parsed
+        if parsed is ALREADY_IMPORTED:
+            self.skipped_files += 1
             return
-        # 检查会话是否存在
+        if parsed is None:
+            parsed = stream_json_file(file_path)
+        conversation_id, rows = parsed
+        if self.conversation_id:
+            # 追加到指定会话时，用指定的会话ID替换消息行中的会话ID
+            conversation_id = self.conversation_id
+            rows = ((row[0], conversation_id) + tuple(row[2:]) for row in rows)
+        message_count = 0
         if conversation_id:
-            cursor.execute('SELECT conversation_id FROM conversations WHERE conversation_id=?', (conversation_id,))
-            existing_conversation = cursor.fetchone()
-            if existing_conversation:
-                if not suppress_prompts:
-                    messagebox.showinfo("信息", "正在将新消息追加到现有会话。")
-            else:
-                if not suppress_prompts:
-                    conversation_name = simpledialog.askstring("输入", "为此会话输入一个名称:")
-                    if not conversation_name:
-                        conversation_name = f"Conversation {conversation_id[:8]}"
-                else:
-                    conversation_name = os.path.splitext(os.path.basename(file_path))[0]
-                cursor.execute('''
-                    INSERT OR REPLACE INTO conversations (conversation_id, conversation_name)
-                    VALUES (?, ?)
-                ''', (conversation_id, conversation_name))
+            conversation_name = self.conversation_name or os.path.splitext(os.path.basename(file_path))[0]
+            message_count = self._write_conversation(cursor, conversation_id, conversation_name, rows)
         else:
+            self.missing_id_files.append(file_path)
+        # 与消息写入在同一个保存点中记录，保证导入记录与数据一致
+        file_stat, content_hash = self.file_info[file_path]
+        record_import(cursor, file_path, file_stat, content_hash, conversation_id, message_count)
+
+    def _write_conversation(self, cursor, conversation_id, conversation_name, rows):
+        """写入一个会话的消息，返回处理的消息条数。
+
+        新会话直接批量写入；已存在的会话使用追加模式，只写入新增或内容有变化的消息。
+        """
+        base_rows = self.written_rows
+
+        def on_progress(row_count):
+            self.written_rows = base_rows + row_count
+            if self.batch_checkpoint:
+                self.batch_checkpoint()
+
+        if ensure_conversation(cursor, conversation_id, conversation_name):
+            stats = insert_new_message_rows(cursor, conversation_id, rows, self.batch_size, on_progress)
+            for key, value in stats.items():
+                self.append_stats[key] += value
+            return sum(stats.values())
+        self.created_conversations.append(conversation_id)
+        row_count = insert_message_rows(cursor, rows, self.batch_size, on_progress)
+        self.append_stats["new"] += row_count
+        return row_count
+
+    def _write_multi_conversation_file(self, conn, cursor, file_path, write):
+        """写入包含多个会话、自行管理事务的文件（完整导出、压缩包）。
+
+        write() 返回写入的消息条数，取消时返回 None。返回整个文件是否写完；
+        取消、读取出错、有会话或成员写入失败、或者没有写入任何会话时，已写入的会话保留，
+        文件不记入导入记录，也不移动到备份文件夹，以便之后重新导入。
+        """
+        failed_count = len(self.failed_files)
+        self.file_conversations = []
+        try:
+            message_count = write()
+        except sqlite3.Error:
+            raise
+        except Exception as e:
+            self._rollback(conn)
+            self.failed_files.append((file_path, e))
+            return False
+        if message_count is None or len(self.failed_files) > failed_count:
+            return False
+        if not self.file_conversations:
+            self.failed_files.append((file_path, ValueError("文件中没有可导入的会话")))
+            return False
+        file_stat, content_hash = self.file_info[file_path]
+        self._begin(cursor)
+        record_import(cursor, file_path, file_stat, content_hash, None, message_count, self.file_conversations)
+        return True
+
+    def _write_export(self, conn, cursor, source, label):
+        """逐个会话写入完整导出文件，每个会话单独一个事务，返回消息条数。"""
+        message_count = 0
+        for conversation in iter_export_conversations(source):
+            if self.cancel_event.is_set():
+                return None
+            conversation_id = conversation.get('conversation_id') or conversation.get('id')
+            # 没有 mapping 的条目不是会话（如分享记录、反馈记录），跳过而不是创建空会话
+            if not conversation_id or not isinstance(conversation.get('mapping'), dict):
+                continue
+            self._begin(cursor)
+            try:
+                conversation_name = conversation.get('title') or f"Conversation {conversation_id[:8]}"
+                rows = (message_to_row(message, conversation_id) for message in iter_mapping_messages(conversation))
+                message_count += self._write_conversation(cursor, conversation_id, conversation_name, rows)
+                store_message_tree(cursor, conversation_id, *mapping_parent_links(conversation))
+                self._commit(conn)
+                self.exported_conversations += 1
+                self.file_conversations.append(conversation_id)
+            except sqlite3.Error:
+                raise
+            except Exception as e:
+                # 单个会话数据有误时只跳过该会话
+                self._rollback(conn)
+                self.failed_files.append((f"{label}#{conversation_id}", e))
+        return message_count
+
+    def _write_archive(self, conn, cursor, file_path):
+        """逐个成员写入压缩包，分享文件成员各自一个事务，返回消息条数。"""
+        message_count = 0
+        for member_name, json_format, source in iter_archive_members(file_path):
+            if self.cancel_event.is_set():
+                return None
+            label = f"{file_path}#{member_name}"
+            if json_format == 'export':
+                member_count = self._write_export(conn, cursor, source, label)
+                if member_count is None:
+                    return None
+                message_count += member_count
+                continue
+            self._begin(cursor)
+            try:
+                conversation_id, rows = stream_json_file(source)
+                if conversation_id:
+                    conversation_name = os.path.splitext(os.path.basename(member_name))[0]
+                    message_count += self._write_conversation(cursor, conversation_id, conversation_name, rows)
+                    self.exported_conversations += 1
+                    self.file_conversations.append(conversation_id)
+                self._commit(conn)
+            except sqlite3.Error:
+                raise
+            except Exception as e:
+                self._rollback(conn)
+                self.failed_files.append((label, e))
+        return message_count
+
+    def _begin(self, cursor):
+        """取得写锁并开始事务，写锁在 _commit 或 _rollback 时释放。"""
+        db.write_lock.acquire()
+        self.holds_write_lock = True
+        self.transaction_start = time.perf_counter()
+        cursor.execute('BEGIN')
+
+    def _release_write_lock(self):
+        if self.holds_write_lock:
+            self.holds_write_lock = False
+            db.write_lock.release()
+            time.sleep(0)  # 让出执行权，等待写锁的线程有机会先取得写锁
+
+    def _commit(self, conn, uncommitted=None):
+        """提交当前事务并释放写锁，通知调用方这些文件已经落盘。"""
+        # 没有持有写锁时写连接可能正被其他线程使用，不能提交
+        if self.holds_write_lock:
+            conn.commit()
+            self._release_write_lock()
+        if uncommitted:
+            self.written_files += len(uncommitted)
+            for file_path in uncommitted:
+                self.done_queue.put(file_path)
+            uncommitted.clear()
+
+    def _checkpoint(self, conn, cursor, uncommitted):
+        """流式写入大文件时，事务超过 WRITE_TRANSACTION_MAX_SECONDS 就提交已写入的批次并释放写锁，
+        再在新事务中继续，界面上的写操作不必等整个文件写完。
+
+        导入记录仍在文件写完的最后一个事务中写入：中途退出时文件不在导入记录中，
+        下次导入以追加模式补齐，不会重复写入已提交的消息。
+        """
+        if time.perf_counter() - self.transaction_start < WRITE_TRANSACTION_MAX_SECONDS:
+            return
+        cursor.execute('RELEASE import_file')
+        self._commit(conn, uncommitted)
+        self._begin(cursor)
+        cursor.execute('SAVEPOINT import_file')
+
+    def _rollback(self, conn):
+        """回滚当前事务（如果有）并释放写锁。"""
+        if self.holds_write_lock and conn.in_transaction:
+            conn.rollback()
+        self._release_write_lock()
+
+    def cancel(self):
+        """请求在当前文件写完后停止导入。"""
+        self.cancel_event.set()
+
+    def progress(self):
+        """返回供进度面板显示的进度数据，可在任意线程调用。"""
+        elapsed = time.perf_counter() - self.start_time
+        total_files = len(self.file_paths)
+        eta = None
+        if self.processed_files:
+            eta = elapsed / self.processed_files * (total_files - self.processed_files)
+        return {
+            "files_done": self.processed_files,
+            "total_files": total_files,
+            "rows": self.written_rows,
+            "rate": self.written_rows / elapsed if elapsed > 0 else 0,
+            "eta": eta,
+            "stages": self.status_text(),
+        }
+
+    def status_text(self):
+        """返回各阶段吞吐量，便于判断瓶颈在解析还是写入。"""
+        now = time.perf_counter()
+        parse_elapsed = (self.parse_end_time or now) - self.start_time
+        write_elapsed = now - self.start_time
+        parse_rate = self.parsed_rows / parse_elapsed if parse_elapsed > 0 else 0
+        write_rate = self.written_rows / self.write_busy if self.write_busy > 0 else 0
+        write_idle = 1 - self.write_busy / write_elapsed if write_elapsed > 0 else 0
+        return (f"解析: {self.parsed_files} 个文件，{parse_rate:.0f} 条/秒 | "
+                f"写入: {self.written_files}/{len(self.file_paths)} 个文件，{self.written_rows} 条，{write_rate:.0f} 条/秒 | "
+                f"新增/未变/更新: {self.append_stats['new']}/{self.append_stats['unchanged']}/{self.append_stats['changed']} 条 | "
+                f"已导入过: {self.skipped_files} 个文件 | 完整导出/压缩包: {self.exported_conversations} 个会话 | "
+                f"队列: {self.parsed_queue.qsize()} | 写入线程空闲 {write_idle:.0%}")
+
+# ====================== 后台导入任务 ======================
+current_import = None  # 正在运行的后台导入流水线，同一时间只允许一个
+auto_import_pending = False  # 导入进行中又有新文件到达，结束后需要再导入一次
+
+class ImportProgressPanel(tk.Toplevel):
+    """非模态的导入进度面板，显示文件进度、消息数、吞吐量和剩余时间。"""
+    def __init__(self, title, on_cancel):
+        super().__init__(root)
+        self.title(title)
+        self.geometry("520x210")
+        self.transient(root)
+        self.on_cancel = on_cancel
+        self.progressbar = ttk.Progressbar(self, mode='determinate')
+        self.progressbar.pack(fill=tk.X, padx=10, pady=10)
+        self.files_label = ttk.Label(self, text="文件: 0/0")
+        self.files_label.pack(anchor='w', padx=10)
+        self.rows_label = ttk.Label(self, text="已写入消息: 0")
+        self.rows_label.pack(anchor='w', padx=10)
+        self.rate_label = ttk.Label(self, text="吞吐量: - | 剩余时间: -")
+        self.rate_label.pack(anchor='w', padx=10)
+        self.stages_label = ttk.Label(self, text="", wraplength=500)
+        self.stages_label.pack(anchor='w', padx=10, pady=5)
+        self.cancel_button = ttk.Button(self, text="取消", command=self.cancel)
+        self.cancel_button.pack(pady=5)
+        # 关闭窗口等同于取消
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+
+    def update_progress(self, progress):
+        self.progressbar.config(maximum=max(progress["total_files"], 1), value=progress["files_done"])
+        self.files_label.config(text=f"文件: {progress['files_done']}/{progress['total_files']}")
+        self.rows_label.config(text=f"已写入消息: {progress['rows']}")
+        eta = f"{progress['eta']:.0f} 秒" if progress["eta"] is not None else "-"
+        self.rate_label.config(text=f"吞吐量: {progress['rate']:.0f} 条/秒 | 剩余时间: {eta}")
+        self.stages_label.config(text=progress["stages"])
+
+    def cancel(self):
+        self.cancel_button.config(state=tk.DISABLED, text="正在取消…")
+        self.on_cancel()
+
+def start_import_job(pipeline, title, on_file_done=None, on_finished=None, show_panel=True):
+    """在后台线程运行导入流水线，进度通过线程安全的队列交给主线程显示。
+
+    on_file_done(file_path) 在主线程中对每个已提交的文件调用；
+    on_finished(error) 在导入结束（包括取消）后于主线程中调用。
+    show_panel 为 False 时（自动导入）不打开进度窗口，进度只显示在状态栏中。
+    """
+    global current_import
+    current_import = pipeline
+    events = queue.Queue()
+    panel = ImportProgressPanel(title, pipeline.cancel) if show_panel else None
+
+    def worker():
+        try:
+            pipeline.run(lambda: events.put(("progress", pipeline.progress())))
+            events.put(("finished", None))
+        except Exception as e:
+            events.put(("finished", e))
+
+    def poll_events():
+        global current_import
+        while not pipeline.done_queue.empty():
+            file_path = pipeline.done_queue.get_nowait()
+            if on_file_done:
+                on_file_done(file_path)
+        finished = False
+        error = None
+        progress = None
+        while not events.empty():
+            kind, payload = events.get_nowait()
+            if kind == "progress":
+                progress = payload
+            else:
+                finished, error = True, payload
+        if progress:
+            if panel:
+                panel.update_progress(progress)
+            status_var.set(progress["stages"])
+        if not finished:
+            root.after(100, poll_events)
+            return
+        # 处理结束前最后提交的文件
+        while not pipeline.done_queue.empty():
+            file_path = pipeline.done_queue.get_nowait()
+            if on_file_done:
+                on_file_done(file_path)
+        current_import = None
+        if panel:
+            panel.destroy()
+        if on_finished:
+            on_finished(error)
+
+    threading.Thread(target=worker, daemon=True).start()
+    root.after(100, poll_events)
+
+# ====================== 导入JSON文件 ======================
+def import_json(file_path, conn, selected_conversation_id=None, suppress_prompts=False):
+    """导入单个JSON文件到数据库，消息在后台线程中写入。
+
+    界面线程只读取文件开头判断格式、按文件名/大小/修改时间查找导入记录；
+    读取会话ID和计算内容哈希都在导入流水线中进行，大文件不会卡住界面。
+    """
+    if current_import:
+        messagebox.showinfo("提示", "已有导入任务正在进行，请稍后再试。")
+        return
+    try:
+        cursor = conn.cursor()
+        # 压缩包和完整导出的 conversations.json 包含多个会话，会话名称取自各自的标题或文件名
+        is_export = is_archive(file_path) or detect_json_format(file_path) == 'export'
+        if is_export and selected_conversation_id:
             if not suppress_prompts:
-                messagebox.showerror("错误", "无法找到有效的会话ID。")
+                messagebox.showerror("错误", "压缩包或完整导出文件包含多个会话，不能追加到单个会话。")
             return
-        # 插入消息
-        for message in data.get('messages', []):
-            message_id = message.get('id')
-            author_role = message.get('author', {}).get('role', '')
-            content_parts = message.get('content', {}).get('parts', [])
-            content = "\n".join([str(part) if isinstance(part, str) else "[Non-text content]" for part in content_parts])
-            create_time = str(message.get('create_time', ''))
-            cursor.execute('''
-                INSERT OR REPLACE INTO messages (message_id, conversation_id, author_role, content, create_time)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (message_id, conversation_id, author_role, content, create_time))
-        conn.commit()
-        if not suppress_prompts:
-            messagebox.showinfo("成功", "消息成功追加！")
-        load_conversations(conn)
+        # 检查文件是否已经导入过；内容相同但名称或修改时间不同的文件由流水线按内容哈希跳过
+        use_ledger = True
+        record = find_import_record_by_stat(cursor, file_path, os.stat(file_path))
+        if record:
+            if suppress_prompts:
+                return
+            if not messagebox.askyesno("已导入过", f"该文件已于 {record[2]} 导入到会话 {record[0]}（{record[1]} 条消息），是否仍要导入？"):
+                return
+            use_ledger = False
     except Exception as e:
         if not suppress_prompts:
             messagebox.showerror("错误", f"导入失败: {e}")
-    finally:
-        root.config(cursor="")
-        root.update_idletasks()
+        return
+
+    pipeline = ImportPipeline([file_path], load_config(), selected_conversation_id, use_ledger=use_ledger)
+
+    def on_finished(error):
+        # 完整导出中个别会话失败不影响其余会话，只有整个文件失败才报错
+        for failed_path, failed_error in pipeline.failed_files:
+            if failed_path == file_path:
+                error = failed_error
+        if error:
+            if not suppress_prompts:
+                messagebox.showerror("错误", f"导入失败: {error}")
+        elif not pipeline.cancel_event.is_set() and not suppress_prompts:
+            if pipeline.skipped_files:
+                messagebox.showinfo("已导入过", "该文件的内容已经导入过，已跳过。")
+            elif file_path in pipeline.missing_id_files:
+                messagebox.showerror("错误", "无法找到有效的会话ID。")
+            elif is_export:
+                summary = f"已导入 {pipeline.exported_conversations} 个会话，共 {pipeline.written_rows} 条消息！"
+                if pipeline.failed_files:
+                    summary += f"\n{len(pipeline.failed_files)} 个会话导入失败。"
+                messagebox.showinfo("成功", summary)
+            elif pipeline.created_conversations:
+                # 会话ID在导入时才读出，新会话的名称在导入完成后再询问
+                conversation_id = pipeline.created_conversations[0]
+                conversation_name = simpledialog.askstring("输入", "为此会话输入一个名称:")
+                if not conversation_name:
+                    conversation_name = f"Conversation {conversation_id[:8]}"
+                try:
+                    with db.writer() as write_conn:
+                        write_conn.execute('UPDATE conversations SET conversation_name=? WHERE conversation_id=?',
+                                           (conversation_name, conversation_id))
+                        write_conn.commit()
+                except sqlite3.Error as e:
+                    messagebox.showerror("错误", f"重命名会话失败: {e}")
+                messagebox.showinfo("成功", f"已导入 {pipeline.written_rows} 条消息！")
+            else:
+                stats = pipeline.append_stats
+                messagebox.showinfo("成功", f"消息成功追加！\n新增 {stats['new']} 条，未变 {stats['unchanged']} 条，更新 {stats['changed']} 条。")
+        schedule_conversation_list_refresh()
 
-def batch_import_json():
-    """批量导入指定目录下的JSON文件。"""
+    start_import_job(pipeline, "导入JSON", on_finished=on_finished)
+
+def batch_import_json(quiet=False):
+    """在后台批量导入指定目录下的JSON文件。quiet 为 True 时（自动导入）不弹出提示。"""
     config = load_config()
     directory_path = config["download_directory"]
     if directory_path and os.path.isdir(directory_path):
-        json_files = [f for f in os.listdir(directory_path) if f.lower().endswith('.json') and os.path.isfile(os.path.join(directory_path, f))]
+        global auto_import_pending
+        if current_import:
+            if quiet:
+                # 当前导入结束后再处理新到的文件
+                auto_import_pending = True
+            else:
+                messagebox.showinfo("提示", "已有导入任务正在进行，请稍后再试。")
+            return
+        auto_import_pending = False
+        # 跳过仍在下载中的文件
+        json_files = [f for f in os.listdir(directory_path) if is_import_candidate(os.path.join(directory_path, f))]
         if json_files:
-            root.config(cursor="wait")
-            root.update_idletasks()
-            for json_file in json_files:
-                file_path = os.path.join(directory_path, json_file)
-                import_json(file_path, conn, suppress_prompts=True)
-                # 移动到备份文件夹
-                move_to_backup(file_path, directory_path)
-            root.config(cursor="")
-            root.update_idletasks()
-            load_conversations(conn)
-            # 如果启用了AI自动重命名，则在导入后进行重命名
-            if config.get("enable_ai_rename", False):
-                ai_automatic_rename()
+            file_paths = [os.path.join(directory_path, json_file) for json_file in json_files]
+            pipeline = ImportPipeline(file_paths, config)
+
+            def on_finished(error):
+                if error:
+                    messagebox.showerror("错误", f"批量导入失败: {error}")
+                elif pipeline.failed_files:
+                    report_failed_imports(pipeline.failed_files, quiet)
+                schedule_conversation_list_refresh()
+                # 如果启用了AI自动重命名，则在导入后进行重命名
+                if config.get("enable_ai_rename", False):
+                    ai_automatic_rename()
+                if auto_import_pending:
+                    batch_import_json(quiet=True)
+
+            # 已提交的文件移动到备份文件夹，取消时未处理的文件保留在原处
+            start_import_job(pipeline, "批量导入JSON",
+                             on_file_done=lambda path: move_to_backup(path, directory_path),
+                             on_finished=on_finished, show_panel=not quiet)
         else:
             pass  # 没有找到JSON文件，不提示
     else:
         messagebox.showwarning("警告", "请先在配置中设置有效的下载目录。")
 
+def report_failed_imports(failed_files, quiet):
+    """报告批量导入中失败的文件和会话。压缩包和完整导出文件有失败时保留在下载目录中。"""
+    if quiet:
+        status_var.set(f"自动导入：{len(failed_files)} 个文件或会话导入失败，"
+                       f"如 {os.path.basename(failed_files[0][0])}: {failed_files[0][1]}")
+        return
+    lines = [f"{os.path.basename(path)}: {e}" for path, e in failed_files[:10]]
+    if len(failed_files) > 10:
+        lines.append(f"……共 {len(failed_files)} 项")
+    messagebox.showwarning("部分导入失败", "以下文件或会话导入失败：\n" + "\n".join(lines))
+
 def move_to_backup(file_path, directory):
-    """将已处理的文件移动到备份文件夹。"""
+    """将已处理的文件移动到备份文件夹。文件已被移走或删除时不做处理。"""
+    if not os.path.exists(file_path):
+        return
     backup_folder = os.path.join(directory, "sharedchat_history_backup")
     if not os.path.exists(backup_folder):
         os.makedirs(backup_folder)
@@ -329,9 +2074,15 @@ def select_directory_and_import():
         # 刷新会话列表
         batch_import_json()
 
+# 导入文件选择框的文件类型
+IMPORT_FILETYPES = [
+    ("JSON/压缩包", "*.json *.zip *.json.gz *.json.bz2 *.json.xz *.json.zst *.tar *.tgz *.tar.gz *.tar.bz2 *.tar.xz *.tar.zst"),
+    ("JSON Files", "*.json"),
+]
+
 def select_file():
-    """选择单个JSON文件并导入。"""
-    file_path = filedialog.askopenfilename(filetypes=[("JSON Files", "*.json")])
+    """选择单个JSON文件或压缩包并导入。"""
+    file_path = filedialog.askopenfilename(filetypes=IMPORT_FILETYPES)
     if file_path:
         import_json(file_path, conn)
 
@@ -345,137 +2096,705 @@ def update_batch_import_button_text():
         batch_import_button.config(text="批量导入JSON")
 
 # ====================== 加载会话和消息 ======================
-def load_conversations(conn, search_query=""):
-    """从数据库加载会话列表。"""
+# 会话列表的排序方式：(显示名称, ORDER BY 子句)；除导入顺序外都按 conversation_stats 上的索引排序
+CONVERSATION_SORT_ORDERS = {
+    "imported": ("导入顺序", None),
+    "last_activity": ("最近活动", "s.last_ts DESC"),
+    "message_count": ("消息数量", "s.message_count DESC"),
+    "size": ("内容大小", "s.bytes DESC"),
+}
+# 会话列表中当前显示的 (conversation_id, conversation_name[, snippet, message_id])，与列表项一一对应；
+# 内容搜索的结果带有匹配片段和匹配消息的ID，选中时直接定位到该消息
+displayed_conversations = []
+conversation_list_refresh_job = None  # 已安排但尚未执行的会话列表刷新
+
+def format_conversation_item(conversation_id, conversation_name, snippet=None, message_id=None):
+    """会话列表中一项的显示文本，内容搜索时附带匹配片段。"""
+    if snippet:
+        return f"{conversation_name} ({conversation_id})  {snippet}"
+    return f"{conversation_name} ({conversation_id})"
+
+def load_conversations(conn, search_query="", search_mode="name", sort="imported"):
+    """从数据库加载会话列表，只增删改发生变化的列表项。
+
+    内容搜索的结果按匹配程度排列，其余情况按 sort 指定的方式排序。
+    """
     try:
         cursor = conn.cursor()
-        if search_query:
-            cursor.execute('SELECT conversation_id, conversation_name FROM conversations WHERE conversation_name LIKE ?', ('%' + search_query + '%',))
+        if search_query and search_mode == "content":
+            records = search_message_content(cursor, search_query)
+            if records is not None:
+                update_conversations_listbox(records)
+                return
+        where, params = ('WHERE c.conversation_name LIKE ?', ('%' + search_query + '%',)) if search_query else ('', ())
+        order_by = CONVERSATION_SORT_ORDERS.get(sort, CONVERSATION_SORT_ORDERS["imported"])[1]
+        if order_by:
+            cursor.execute(f'''
+                SELECT c.conversation_id, c.conversation_name
+                FROM conversation_stats s JOIN conversations c ON c.conversation_id = s.conversation_id
+                {where} ORDER BY {order_by}
+            ''', params)
         else:
-            cursor.execute('SELECT conversation_id, conversation_name FROM conversations')
-        records = cursor.fetchall()
-        conversations_listbox.delete(0, tk.END)
-        for record in records[::-1]:
-            conversations_listbox.insert(tk.END, f"{record[1]} ({record[0]})")
+            cursor.execute(f'SELECT c.conversation_id, c.conversation_name FROM conversations c {where} ORDER BY c.rowid DESC', params)
+        update_conversations_listbox(cursor.fetchall())
     except sqlite3.Error as e:
         messagebox.showerror("错误", f"加载会话失败: {e}")
 
-def load_messages(conversation_id, conn, page=0):
-    """从数据库加载指定会话的消息，并显示在HTML框中。"""
-    global current_html_content, selected_conversation_id, is_dark_mode
-    offset = page * messages_per_page
-    selected_conversation_id = conversation_id
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT author_role, content, create_time FROM messages WHERE conversation_id=? ORDER BY create_time LIMIT ? OFFSET ?', (conversation_id, messages_per_page, offset))
-        messages = cursor.fetchall()
-        html_content = ""
-        for msg in messages:
-            author_role, content, create_time = msg
-
-            # 处理空值并进行转义
-            author_role = html.escape(author_role) if author_role else "未知角色"
-            content = content if content else "[无内容]"
-            try:
-                create_time_formatted = datetime.fromtimestamp(float(create_time)).strftime('%Y-%m-%d %H:%M:%S')
-            except (ValueError, TypeError):
-                create_time_formatted = create_time
-            create_time_formatted = create_time_formatted if create_time_formatted else "未知时间"
+def schedule_conversation_list_refresh():
+    """合并多次刷新请求，在界面空闲时按当前搜索条件只刷新一次会话列表。"""
+    global conversation_list_refresh_job
 
-            # 渲染 Markdown，禁用原始 HTML
-            md.options['html'] = False
-            try:
-                content_html = md.render(content)
-            except Exception as e:
-                content_html = "<p>[内容渲染失败]</p>"
+    def refresh():
+        global conversation_list_refresh_job
+        conversation_list_refresh_job = None
+        load_conversations(conn, search_query, search_mode, conversation_sort)
 
-            # 使用模板引擎生成安全的 HTML
-            formatted_message = template.render(
-                author_role=author_role,
-                create_time_formatted=create_time_formatted,
-                content_html=content_html
-            )
-            html_content += formatted_message
-        # 更新HTML内容
-        if page == 0:
-            current_html_content = html_content
+    if conversation_list_refresh_job is None:
+        conversation_list_refresh_job = root.after_idle(refresh)
+
+def update_conversations_listbox(records):
+    """把会话列表更新为 records，保留滚动位置和选中的会话。
+
+    已显示的会话顺序不变时（例如导入后只新增了会话），只插入新增项、
+    删除已删除项并原地更新改名项；否则整体重建列表。
+    """
+    selection = conversations_listbox.curselection()
+    selected_id = displayed_conversations[selection[0]][0] if selection else None
+    top_index = conversations_listbox.nearest(0)
+    new_ids = {record[0] for record in records}
+    kept = [record for record in displayed_conversations if record[0] in new_ids]
+    # 保留下来的会话必须仍按原顺序出现在新列表中，才能增量更新
+    kept_index = 0
+    for record in records:
+        if kept_index < len(kept) and kept[kept_index][0] == record[0]:
+            kept_index += 1
+    if not kept or kept_index < len(kept) or len(kept) < len(displayed_conversations) // 2:
+        conversations_listbox.delete(0, tk.END)
+        conversations_listbox.insert(tk.END, *[format_conversation_item(*record) for record in records])
+        displayed_conversations[:] = [tuple(record) for record in records]
+    else:
+        # 删除已不存在的会话（从后往前删，索引不受影响）
+        for index in range(len(displayed_conversations) - 1, -1, -1):
+            if displayed_conversations[index][0] not in new_ids:
+                conversations_listbox.delete(index)
+                del displayed_conversations[index]
+                if index < top_index:
+                    top_index -= 1
+        # 按新顺序合并：插入新增的会话，原地更新改名（或匹配片段变化）的会话
+        for index, record in enumerate(records):
+            record = tuple(record)
+            if index < len(displayed_conversations) and displayed_conversations[index][0] == record[0]:
+                if displayed_conversations[index] != record:
+                    conversations_listbox.delete(index)
+                    conversations_listbox.insert(index, format_conversation_item(*record))
+                    displayed_conversations[index] = record
+            else:
+                conversations_listbox.insert(index, format_conversation_item(*record))
+                displayed_conversations.insert(index, record)
+                if index <= top_index:
+                    top_index += 1
+        conversations_listbox.yview(max(top_index, 0))
+    # 恢复选中项（不会触发 <<ListboxSelect>>）
+    conversations_listbox.selection_clear(0, tk.END)
+    for index, record in enumerate(displayed_conversations):
+        if record[0] == selected_id:
+            conversations_listbox.selection_set(index)
+            break
+
+def selected_list_conversation_id():
+    """返回会话列表中选中的会话ID，没有选中时返回 None。"""
+    selection = conversations_listbox.curselection()
+    if selection:
+        return displayed_conversations[selection[0]][0]
+    return None
+
+def fetch_message_page(cursor, conversation_id, direction="first", key=None):
+    """按键集分页读取一页消息，返回按时间正序排列的
+    [(create_ts, rowid, author_role, content, create_display, message_id, body_hash)]。
+
+    消息按 (create_ts, rowid) 排序，key 是这个排序键上的位置：
+    "first"/"last" 取会话开头/末尾一页，"next" 取 key 之后一页，"previous" 取 key 之前一页，
+    "from" 取从 key（含）开始的一页。每种方式都是 (conversation_id, create_ts) 索引上的一次定位，
+    与页码无关。
+    """
+    conditions = {
+        "first": ("", "ASC"),
+        "from": ("AND (m.create_ts, m.rowid) >= (?, ?)", "ASC"),
+        "next": ("AND (m.create_ts, m.rowid) > (?, ?)", "ASC"),
+        "previous": ("AND (m.create_ts, m.rowid) < (?, ?)", "DESC"),
+        "last": ("", "DESC"),
+    }
+    condition, order = conditions[direction]
+    cursor.execute(f'''
+        SELECT m.create_ts, m.rowid, m.author_role, b.content, m.create_display, m.message_id, b.body_hash
+        FROM messages m JOIN message_bodies b ON b.body_id = m.body_id
+        WHERE m.conversation_id=? {condition}
+        ORDER BY m.create_ts {order}, m.rowid {order} LIMIT ?
+    ''', (conversation_id, *(key if condition else ()), messages_per_page))
+    rows = cursor.fetchall()
+    return rows[::-1] if order == "DESC" else rows
+
+def message_page_key(cursor, message_id):
+    """返回消息在排序键 (create_ts, rowid) 上的位置，消息不存在时返回 None。"""
+    return cursor.execute('SELECT create_ts, rowid FROM messages WHERE message_id=?', (message_id,)).fetchone()
+
+def resolve_branch_path(cursor, leaf_id):
+    """用递归 CTE 从叶子消息沿 parent_id 走到根，返回从根到叶的消息ID列表。"""
+    cursor.execute('''
+        WITH RECURSIVE path (message_id, depth) AS (
+            SELECT ?, 0
+            UNION ALL
+            SELECT p.parent_id, path.depth + 1
+            FROM message_parents p JOIN path ON p.message_id = path.message_id
+            WHERE p.parent_id IS NOT NULL AND path.depth < ?
+        )
+        SELECT message_id FROM path ORDER BY depth DESC
+    ''', (leaf_id, BRANCH_PATH_MAX_DEPTH))
+    return [row[0] for row in cursor.fetchall()]
+
+def branch_leaf(cursor, message_id):
+    """从消息出发，每一层走向最新的子消息，返回所在分支的叶子消息ID。切换分支时才按需查询。"""
+    cursor.execute('''
+        WITH RECURSIVE descend (message_id, depth) AS (
+            SELECT ?, 0
+            UNION ALL
+            SELECT (SELECT p.message_id FROM message_parents p JOIN messages m ON m.message_id = p.message_id
+                    WHERE p.parent_id = descend.message_id
+                    ORDER BY m.create_ts DESC, m.rowid DESC LIMIT 1),
+                   descend.depth + 1
+            FROM descend WHERE descend.message_id IS NOT NULL AND descend.depth < ?
+        )
+        SELECT message_id FROM descend WHERE message_id IS NOT NULL ORDER BY depth DESC LIMIT 1
+    ''', (message_id, BRANCH_PATH_MAX_DEPTH))
+    return cursor.fetchone()[0]
+
+def active_branch_path(cursor, conversation_id, message_id=None, current_path=None):
+    """返回要显示的分支（从根到叶的消息ID列表），会话没有对话树时返回 None。
+
+    默认显示导出时的当前分支；给出 message_id 且它不在 current_path（默认为当前分支）上时，
+    切换到经过它的最新分支。
+    """
+    row = cursor.execute('SELECT current_node FROM conversations WHERE conversation_id=?', (conversation_id,)).fetchone()
+    if not row or not row[0]:
+        return None
+    path = current_path or resolve_branch_path(cursor, row[0])
+    if message_id is None or message_id in path:
+        return path
+    if not cursor.execute('SELECT 1 FROM message_parents WHERE message_id=?', (message_id,)).fetchone():
+        return None
+    return resolve_branch_path(cursor, branch_leaf(cursor, message_id))
+
+def fetch_path_messages(cursor, message_ids):
+    """按给定顺序读取分支上的一段消息，行的格式与 fetch_message_page 相同。"""
+    cursor.execute(f'''
+        SELECT m.create_ts, m.rowid, m.author_role, b.content, m.create_display, m.message_id, b.body_hash
+        FROM messages m JOIN message_bodies b ON b.body_id = m.body_id
+        WHERE m.message_id IN ({', '.join('?' * len(message_ids))})
+    ''', message_ids)
+    rows = {row[5]: row for row in cursor.fetchall()}
+    return [rows[message_id] for message_id in message_ids if message_id in rows]
+
+def branch_siblings(cursor, path, start, end):
+    """查询分支上 path[start:end] 这些消息的兄弟消息，返回 {message_id: 分支导航信息}。
+
+    只有存在兄弟消息（被编辑或重新生成过）的消息才有导航信息，兄弟分支本身在点击时才加载。
+    """
+    parents = {path[index - 1]: path[index] for index in range(max(start, 1), end)}
+    if not parents:
+        return {}
+    cursor.execute(f'''
+        SELECT p.parent_id, p.message_id
+        FROM message_parents p JOIN messages m ON m.message_id = p.message_id
+        WHERE p.parent_id IN ({', '.join('?' * len(parents))})
+        ORDER BY m.create_ts, m.rowid
+    ''', list(parents))
+    children = {}
+    for parent_id, child_id in cursor.fetchall():
+        children.setdefault(parent_id, []).append(child_id)
+    branches = {}
+    for parent_id, child_id in parents.items():
+        siblings = children.get(parent_id, [])
+        if len(siblings) > 1 and child_id in siblings:
+            position = siblings.index(child_id)
+            branches[child_id] = {
+                "position": position + 1,
+                "count": len(siblings),
+                "previous": siblings[position - 1] if position > 0 else None,
+                "next": siblings[position + 1] if position + 1 < len(siblings) else None,
+            }
+    return branches
+
+def render_content_html(content, body_hash, renderer=md):
+    """渲染一条消息正文的 Markdown 并存入渲染缓存，返回 HTML；渲染失败时返回 None，不缓存。"""
+    content = decode_content(content) if content else "[无内容]"
+    # 渲染 Markdown，禁用原始 HTML
+    renderer.options['html'] = False
+    try:
+        content_html = renderer.render(content)
+    except Exception:
+        return None
+    render_cache.put(body_hash, content_html)
+    return content_html
+
+def render_message_rows(cursor, messages, branches=None):
+    """把消息行渲染为 HTML 片段，branches 为 branch_siblings 返回的分支导航信息。
+
+    正文的 Markdown 渲染结果从 render_cache 中取，只有未缓存的正文才调用 md.render。
+    """
+    branches = branches or {}
+    rendered = render_cache.get_many(cursor, [row[6] for row in messages])
+    html_content = ""
+    for _, _, author_role, content, create_display, message_id, body_hash in messages:
+        # 处理空值并进行转义
+        author_role = html.escape(author_role) if author_role else "未知角色"
+        create_time_formatted = create_display if create_display else "未知时间"
+
+        content_html = rendered.get(body_hash)
+        if content_html is None:
+            content_html = render_content_html(content, body_hash)
+            if content_html is None:
+                content_html = "<p>[内容渲染失败]</p>"
+            else:
+                rendered[body_hash] = content_html
+
+        # 使用模板引擎生成安全的 HTML
+        formatted_message = template.render(
+            author_role=author_role,
+            create_time_formatted=create_time_formatted,
+            content_html=content_html,
+            branch=branches.get(message_id)
+        )
+        html_content += formatted_message
+    return html_content
+
+def load_messages(conversation_id, conn, direction="first", message_id=None, message_index=None):
+    """从数据库加载指定会话的一页消息，并显示在HTML框中。
+
+    direction 为 "first"/"last" 时显示会话开头/末尾一页，"next"/"previous" 时在已显示的
+    消息之后追加或之前插入一页；给出 message_id 时从该消息开始显示，调用方已知该消息的序号时
+    通过 message_index 传入，免去一次计数。返回读到的消息条数。
+    有对话树的会话只显示当前分支上的消息，沿分支分页；其他会话按时间顺序键集分页。
+    文档中最多保留 MESSAGE_WINDOW_PAGES 页，超出时淘汰另一端的页。
+    """
+    global current_html_content, selected_conversation_id, active_path, page_serial, window_first_index
+    try:
+        cursor = conn.cursor()
+        if message_id is not None or direction not in ("next", "previous"):
+            current_path = active_path if conversation_id == selected_conversation_id and message_id is not None else None
+            active_path = active_branch_path(cursor, conversation_id, message_id, current_path)
+        selected_conversation_id = conversation_id
+        if active_path:
+            page = load_path_page(cursor, direction, message_id)
         else:
-            current_html_content += html_content
-        # 定义主题颜色
-        if is_dark_mode:
-            body_bg_color = "#333"
-            text_color = "#fff"
-            border_color = "#555"
+            page = load_keyset_page(cursor, conversation_id, direction, message_id)
+        if page is None:
+            return 0
+        messages, branches, first, last = page
+        html_content = render_message_rows(cursor, messages, branches)
+        if render_cache.pending:
+            threading.Thread(target=render_cache.flush, args=(db,), daemon=True).start()
+        # 每页消息放在一个 div.page 中；翻页时只把新的一页加入已显示的文档，不重新加载整个文档
+        page_serial += 1
+        page_id = f"page-{page_serial}"
+        page_html = f'<div class="page" id="{page_id}">{html_content}</div>'
+        page = (page_id, page_html, first, last, len(messages))
+        if direction == "next" and message_id is None:
+            loaded_pages.append(page)
+            html_view.add_html(page_html)
+            if len(loaded_pages) > MESSAGE_WINDOW_PAGES:
+                # 淘汰最前面的一页后，下面的内容整体上移，让新加载的一页显示在视口中
+                window_first_index += evict_page(0)[4]
+                html_view.document.getElementById(page_id).scrollIntoView()
+        elif direction == "previous" and message_id is None:
+            loaded_pages.insert(0, page)
+            window_first_index = max(window_first_index - len(messages), 0)
+            prepend_messages_html(page_html)
+            if len(loaded_pages) > MESSAGE_WINDOW_PAGES:
+                evict_page(-1)
         else:
-            body_bg_color = "#fff"
-            text_color = "#000"
-            border_color = "#ccc"
-        # 构建完整的HTML模板
-        html_template = f"""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Conversation Messages</title>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    padding: 20px;
-                    background-color: {body_bg_color};
-                    color: {text_color};
-                }}
-                .message {{
-                    margin-bottom: 20px;
-                    padding: 10px;
-                    border-bottom: 1px solid {border_color};
-                }}
-                .author {{
-                    font-weight: bold;
-                }}
-                .timestamp {{
-                    color: {text_color};
-                    font-size: 0.9em;
-                }}
-                pre {{
-                    white-space: pre-wrap;
-                }}
-            </style>
-        </head>
-        <body>{current_html_content}</body>
-        </html>
-        """
-        # 显示在HtmlFrame中
-        html_view.load_html(html_template)
+            loaded_pages[:] = [page]
+            if not active_path:
+                window_first_index = keyset_window_index(cursor, direction, message_id, message_index, first, len(messages))
+            current_html_content = page_html
+            show_current_messages()
+        current_html_content = "".join(page[1] for page in loaded_pages)
+        update_conversation_scrollbar(cursor)
+        schedule_prefetch()
+        return len(messages)
     except sqlite3.Error as e:
         messagebox.showerror("错误", f"加载消息失败: {e}")
+        return 0
+
+def evict_page(index):
+    """从文档中删除一页消息并返回这一页。之后翻回这一页时，消息从渲染缓存中重建，不再渲染 Markdown。"""
+    page = loaded_pages.pop(index)
+    html_view.document.getElementById(page[0]).remove()
+    return page
+
+def keyset_window_index(cursor, direction, message_id, message_index, first_key, message_count):
+    """按时间分页重新显示一页时，求这一页第一条消息在会话中的序号。
+
+    开头和末尾一页由会话统计直接得到；跳到指定消息且调用方未给出序号时才计数一次。
+    """
+    if message_index is not None:
+        return message_index
+    if first_key is None or (message_id is None and direction != "last"):
+        return 0
+    if message_id is None:
+        return max(conversation_message_count(cursor, selected_conversation_id) - message_count, 0)
+    # 只在 (conversation_id, create_ts) 索引上计数，不读取消息
+    return cursor.execute('''
+        SELECT COUNT(*) FROM messages WHERE conversation_id=? AND (create_ts, rowid) < (?, ?)
+    ''', (selected_conversation_id, *first_key)).fetchone()[0]
+
+def conversation_message_count(cursor, conversation_id):
+    """会话的消息总数，读取 conversation_stats 中维护好的统计行。"""
+    row = cursor.execute('SELECT message_count FROM conversation_stats WHERE conversation_id=?',
+                         (conversation_id,)).fetchone()
+    return row[0] if row else 0
+
+def load_keyset_page(cursor, conversation_id, direction, message_id):
+    """按时间顺序读取一页消息，返回 (messages, None, 首条的排序键, 末条的排序键)，翻页到头时返回 None。"""
+    key = None
+    if message_id is not None:
+        key = message_page_key(cursor, message_id)
+        direction = "from" if key else "first"
+    elif direction == "next" and loaded_pages:
+        key = loaded_pages[-1][3]
+    elif direction == "previous" and loaded_pages:
+        key = loaded_pages[0][2]
+    if direction in ("next", "previous") and key is None:
+        direction = "first"
+    messages = fetch_message_page(cursor, conversation_id, direction, key)
+    if not messages and direction in ("next", "previous"):
+        return None
+    return messages, None, (messages[0][:2] if messages else None), (messages[-1][:2] if messages else None)
+
+def load_path_page(cursor, direction, message_id):
+    """读取当前分支上的一页消息，返回 (messages, 分支导航信息, start, end)，翻页到头时返回 None。"""
+    if message_id is not None:
+        start = active_path.index(message_id) if message_id in active_path else 0
+        end = min(start + messages_per_page, len(active_path))
+    elif direction == "next" and loaded_pages:
+        start = loaded_pages[-1][3]
+        end = min(start + messages_per_page, len(active_path))
+    elif direction == "previous" and loaded_pages:
+        end = loaded_pages[0][2]
+        start = max(end - messages_per_page, 0)
+    elif direction == "last":
+        start, end = max(len(active_path) - messages_per_page, 0), len(active_path)
+    else:
+        start, end = 0, min(messages_per_page, len(active_path))
+    if start >= end and direction in ("next", "previous") and message_id is None:
+        return None
+    return fetch_path_messages(cursor, active_path[start:end]), branch_siblings(cursor, active_path, start, end), start, end
+
+def message_window_position(cursor):
+    """返回已显示的消息在整个会话（有对话树时为当前分支）中的位置 (first, last, total)，last 不含。"""
+    if not loaded_pages:
+        return 0, 0, 0
+    if active_path:
+        return loaded_pages[0][2], loaded_pages[-1][3], len(active_path)
+    # 按时间分页时位置随翻页增量维护，这里不查询消息表
+    total = conversation_message_count(cursor, selected_conversation_id)
+    last = window_first_index + sum(page[4] for page in loaded_pages)
+    return window_first_index, last, max(total, last)
+
+def update_conversation_scrollbar(cursor):
+    """让会话滚动条表示已显示的消息在整个会话中的位置和比例。"""
+    first, last, total = message_window_position(cursor)
+    if total:
+        conversation_scrollbar.set(first / total, last / total)
+    else:
+        conversation_scrollbar.set(0, 1)
+
+def on_conversation_scroll(*args):
+    """会话滚动条的回调：点击箭头或空白处翻页，拖动时跳到对应位置。"""
+    global conversation_scroll_job
+    if not selected_conversation_id:
+        return
+    if args[0] == "moveto":
+        # 拖动时会连续触发，停下后再跳转
+        if conversation_scroll_job:
+            root.after_cancel(conversation_scroll_job)
+        conversation_scroll_job = root.after(150, jump_to_fraction, float(args[1]))
+    elif args[0] == "scroll":
+        if int(args[1]) > 0:
+            next_page()
+        else:
+            previous_page()
+
+def jump_to_fraction(fraction):
+    """跳到会话中按比例对应的位置，从那里显示一页消息。"""
+    global conversation_scroll_job
+    conversation_scroll_job = None
+    cursor = conn.cursor()
+    _, _, total = message_window_position(cursor)
+    index = max(0, min(int(fraction * total), total - messages_per_page))
+    if active_path:
+        message_id = active_path[index]
+    else:
+        message_id = message_at_index(cursor, selected_conversation_id, index, total)
+        if not message_id:
+            return
+    load_messages(selected_conversation_id, conn, message_id=message_id, message_index=index)
+
+def message_at_index(cursor, conversation_id, index, total):
+    """返回会话中按时间顺序第 index 条消息的ID。
+
+    从会话开头、会话末尾和已显示的第一条消息中离目标最近的一处开始数，
+    只扫描两者之间的索引项，拖动滚动条做小范围跳转时不必从头数起。
+    """
+    # (跳过的条数, 定位条件, 排序方向, 定位的排序键)
+    seeks = [(index, "", "ASC", ()), (total - 1 - index, "", "DESC", ())]
+    first_key = loaded_pages[0][2] if loaded_pages else None
+    if first_key is not None:
+        if index >= window_first_index:
+            seeks.append((index - window_first_index, "AND (create_ts, rowid) >= (?, ?)", "ASC", first_key))
+        else:
+            seeks.append((window_first_index - 1 - index, "AND (create_ts, rowid) < (?, ?)", "DESC", first_key))
+    offset, condition, order, key = min(seeks, key=lambda seek: seek[0])
+    row = cursor.execute(f'''
+        SELECT message_id FROM messages WHERE conversation_id=? {condition}
+        ORDER BY create_ts {order}, rowid {order} LIMIT 1 OFFSET ?
+    ''', (conversation_id, *key, max(offset, 0))).fetchone()
+    return row[0] if row else None
+
+# 消息页的样式表。两种主题的颜色都写在里面，由 body 的 class 选择，切换主题时只改 class
+MESSAGE_STYLESHEET = """
+    body {
+        font-family: Arial, sans-serif;
+        padding: 20px;
+    }
+    body.light {
+        background-color: #fff;
+        color: #000;
+    }
+    body.dark {
+        background-color: #333;
+        color: #fff;
+    }
+    .message {
+        margin-bottom: 20px;
+        padding: 10px;
+        border-bottom: 1px solid #ccc;
+    }
+    body.dark .message {
+        border-bottom-color: #555;
+    }
+    .author {
+        font-weight: bold;
+    }
+    .timestamp {
+        font-size: 0.9em;
+    }
+    pre {
+        white-space: pre-wrap;
+    }
+    .branch {
+        font-size: 0.9em;
+    }
+"""
+
+def theme_class():
+    """当前主题对应的 body class。"""
+    return "dark" if is_dark_mode else "light"
+
+def message_document(body_html):
+    """用样式表和当前主题把消息HTML片段包装成完整的HTML文档。"""
+    return f"""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Conversation Messages</title>
+        <style>{MESSAGE_STYLESHEET}</style>
+    </head>
+    <body class="{theme_class()}">{body_html}</body>
+    </html>
+    """
+
+def show_current_messages():
+    """按当前主题把已加载的消息显示在HTML框中。"""
+    # 显示在HtmlFrame中
+    html_view.load_html(message_document(current_html_content))
+
+def prepend_messages_html(page_html):
+    """在文档开头插入一页消息，并让原来的第一页留在视口顶部，阅读位置不跳动。"""
+    first_page = html_view.document.querySelector("div.page")
+    html_view.add_html(page_html, index=0)
+    first_page.scrollIntoView()
+
+def on_message_link_click(url):
+    """点击分支导航链接时切换到对应的兄弟分支，其他链接按默认方式打开。"""
+    if url.startswith("branch:"):
+        if selected_conversation_id:
+            load_messages(selected_conversation_id, conn, message_id=url[len("branch:"):])
+    else:
+        html_view.load_url(url)
+
+# ====================== 后台预取 ======================
+PREFETCH_WORKERS = 2  # 预取线程数，保持很小，避免与界面线程争抢 GIL
+
+class Prefetcher:
+    """在用户阅读时，用小线程池预先读取并渲染接下来可能查看的消息页，结果进入渲染缓存。
+
+    每次 schedule() 或 cancel() 都使代数加 1；已提交的任务在开始时和渲染每条消息前检查
+    代数，过期即放弃，因此切换选择后旧的预取很快停止。
+    """
+
+    def __init__(self, workers=PREFETCH_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.generation = 0
+        self.local = threading.local()  # 每个线程自己的 Markdown 渲染器
+
+    def cancel(self):
+        """放弃所有已提交的预取。"""
+        self.generation += 1
+
+    def schedule(self, targets):
+        """取消之前的预取并预取 targets：[(conversation_id, message_ids, key)]。
+
+        message_ids 为分支上的一段消息ID；key 为键集分页的位置，预取其后一页；
+        两者都为 None 时预取会话打开时显示的第一页。
+        """
+        self.cancel()
+        generation = self.generation
+        for conversation_id, message_ids, key in targets:
+            self.executor.submit(self._prefetch_page, generation, conversation_id, message_ids, key)
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _prefetch_page(self, generation, conversation_id, message_ids, key):
+        if generation != self.generation:
+            return
+        renderer = getattr(self.local, "renderer", None)
+        if renderer is None:
+            renderer = self.local.renderer = create_markdown_renderer()
+        try:
+            with db.reader() as read_conn:
+                cursor = read_conn.cursor()
+                if message_ids is None and key is None:
+                    path = active_branch_path(cursor, conversation_id)
+                    if path:
+                        message_ids = path[:messages_per_page]
+                if message_ids is not None:
+                    messages = fetch_path_messages(cursor, message_ids)
+                else:
+                    messages = fetch_message_page(cursor, conversation_id, "next" if key else "first", key)
+                # 已在表中缓存的渲染结果同时被读入内存
+                rendered = render_cache.get_many(cursor, [row[6] for row in messages])
+            for row in messages:
+                if generation != self.generation:
+                    return
+                if row[6] not in rendered:
+                    render_content_html(row[3], row[6], renderer)
+                    rendered[row[6]] = True
+        except sqlite3.Error:
+            return  # 预取失败不影响正常显示
+        render_cache.flush(db)
+
+prefetcher = Prefetcher()
+
+def schedule_prefetch():
+    """预取当前会话的下一页，以及会话列表中与选中项相邻的两个会话的第一页。"""
+    targets = []
+    if selected_conversation_id and loaded_pages:
+        if active_path:
+            end = loaded_pages[-1][3]
+            if end < len(active_path):
+                targets.append((selected_conversation_id, active_path[end:end + messages_per_page], None))
+        elif loaded_pages[-1][3] is not None:
+            targets.append((selected_conversation_id, None, loaded_pages[-1][3]))
+    selection = conversations_listbox.curselection()
+    if selection:
+        for index in (selection[0] + 1, selection[0] - 1):
+            if 0 <= index < len(displayed_conversations):
+                targets.append((displayed_conversations[index][0], None, None))
+    prefetcher.schedule(targets)
 
 # ====================== 会话选择处理 ======================
 def on_select_conversation(event):
     """处理会话列表中的选择事件。"""
     selection = conversations_listbox.curselection()
     if selection:
-        conversation = conversations_listbox.get(selection[0])
-        conversation_id = conversation.split('(')[-1].strip(')')
-        global current_page
-        current_page = 0
-        load_messages(conversation_id, conn, current_page)
+        # 先停止旧的预取，避免与本次加载争抢
+        prefetcher.cancel()
+        record = displayed_conversations[selection[0]]
+        conversation_id = record[0]
+        # 内容搜索的结果直接定位到匹配的消息
+        message_id = record[3] if len(record) > 3 else None
+        load_messages(conversation_id, conn, message_id=message_id)
+        status_var.set(conversation_stats_text(conn, conversation_id))
+
+def conversation_stats_text(conn, conversation_id):
+    """会话统计的摘要文本，直接读取 conversation_stats 中维护好的统计行。"""
+    row = conn.execute('''
+        SELECT message_count, user_count, assistant_count, first_ts, last_ts, bytes
+        FROM conversation_stats WHERE conversation_id=?
+    ''', (conversation_id,)).fetchone()
+    if not row:
+        return ""
+    message_count, user_count, assistant_count, first_ts, last_ts, size = row
+    text = f"共 {message_count} 条消息（用户 {user_count}，助手 {assistant_count}），{size / 1024:.1f} KB"
+    if first_ts:
+        text += f"，{format_timestamp(first_ts)} 至 {format_timestamp(last_ts)}"
+    return text
 
 def next_page():
-    """加载下一页消息。"""
-    global current_page
-    current_page += 1
+    """在已显示的消息之后加载下一页。"""
+    if selected_conversation_id and not load_messages(selected_conversation_id, conn, "next"):
+        status_var.set("已经是最后一条消息")
+
+def previous_page():
+    """在已显示的消息之前加载上一页。"""
+    if selected_conversation_id and not load_messages(selected_conversation_id, conn, "previous"):
+        status_var.set("已经是第一条消息")
+
+def last_page():
+    """跳到会话末尾，显示最后一页消息。"""
     if selected_conversation_id:
-        load_messages(selected_conversation_id, conn, current_page)
+        load_messages(selected_conversation_id, conn, "last")
 
 # ====================== 保存HTML ======================
+def iter_conversation_pages(cursor, conversation_id):
+    """逐页产出整个会话的消息行，与界面显示的消息一致：有对话树时为当前分支上的全部消息，
+    否则为会话的全部消息（按时间顺序）。行的格式与 fetch_message_page 相同。
+    """
+    path = active_path if conversation_id == selected_conversation_id else active_branch_path(cursor, conversation_id)
+    if path:
+        for start in range(0, len(path), messages_per_page):
+            yield fetch_path_messages(cursor, path[start:start + messages_per_page])
+        return
+    messages = fetch_message_page(cursor, conversation_id, "first")
+    while messages:
+        yield messages
+        messages = fetch_message_page(cursor, conversation_id, "next", messages[-1][:2])
+
+def iter_export_pages(cursor, conversation_id):
+    """逐页产出整个会话的消息HTML，范围见 iter_conversation_pages。
+
+    与显示时一样从渲染缓存中取正文的渲染结果，导出的文件中不包含分支导航链接。
+    """
+    for messages in iter_conversation_pages(cursor, conversation_id):
+        yield render_message_rows(cursor, messages)
+
 def save_html_to_file():
-    """将当前HTML内容保存到文件。"""
+    """将当前会话的全部消息保存为HTML文件，不限于窗口中已加载的几页。"""
+    if not selected_conversation_id:
+        messagebox.showinfo("提示", "请先选择一个会话。")
+        return
     file_path = filedialog.asksaveasfilename(defaultextension=".html", filetypes=[("HTML Files", "*.html")])
     if file_path:
         try:
+            body_html = "".join(iter_export_pages(conn.cursor(), selected_conversation_id))
+            if render_cache.pending:
+                threading.Thread(target=render_cache.flush, args=(db,), daemon=True).start()
             with open(file_path, "w", encoding="utf-8") as file:
-                file.write(current_html_content)
+                file.write(message_document(body_html))
             messagebox.showinfo("成功", f"HTML内容已保存到 {file_path}!")
         except Exception as e:
             messagebox.showerror("错误", f"保存文件失败: {e}")
@@ -495,70 +2814,330 @@ def toggle_conversations_frame():
 
 
 # ====================== 搜索会话 ======================
+CONTENT_SEARCH_HIT_LIMIT = 2000  # 内容搜索最多取排名靠前的匹配消息数
+CONTENT_SEARCH_RESULT_LIMIT = 200  # 内容搜索最多返回的会话数
+# 匹配的消息超过这个数时不再按 BM25 排名（需要给每条匹配消息打分），改为取最新的消息
+CONTENT_SEARCH_RANK_LIMIT = 20000
+
+# 中日韩文字（假名、汉字、谚文），这些文字不用空格分词
+CJK_CHARACTERS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\U00020000-\U0002fa1f'
+CJK_RUN_PATTERN = re.compile(f'[{CJK_CHARACTERS}]+')
+# 零宽先行断言，一次 findall 取出所有相互重叠的二元词组
+CJK_BIGRAM_PATTERN = re.compile(f'(?=([{CJK_CHARACTERS}]{{2}}))')
+TERM_PART_PATTERN = re.compile(f'[{CJK_CHARACTERS}]+|[^{CJK_CHARACTERS}]+')
+
+def cjk_bigrams(run):
+    """把一串中日韩文字切成相互重叠的二元词组，单个字保持不变。"""
+    if len(run) == 1:
+        return [run]
+    return CJK_BIGRAM_PATTERN.findall(run)
+
+def fts_segment(text):
+    """全文索引写入前的分词：中日韩文字切成二元词组并用空格隔开，其他文字交给 unicode61 分词。
+
+    每串文字末尾再补一个单字，这样任意单字都能作为某个词的前缀被查到。
+    压缩存储的内容先解压，索引的始终是原文。
+    """
+    if not text:
+        return text
+    text = decode_content(text)
+
+    def segment(match):
+        run = match.group()
+        tokens = cjk_bigrams(run)
+        if len(run) > 1:
+            tokens.append(run[-1])
+        return ' ' + ' '.join(tokens) + ' '
+
+    return CJK_RUN_PATTERN.sub(segment, text)
+
+FTS_BACKFILL_BATCH = 2000  # 后台补建全文索引时每个事务处理的正文数，保持写锁的持有时间很短
+
+def build_fts_index(manager, on_progress=None):
+    """按 fts_backfill 中记录的范围，分批为升级前已有的正文建立全文索引。
+
+    每批一个事务，处理完一批就释放写锁，导入和界面上的写操作可以穿插进行；
+    补建范围随每批一起提交，中途退出后下次启动从断点继续。on_progress(done, total) 在每批后调用。
+    """
+    with manager.reader() as read_conn:
+        row = read_conn.execute('SELECT next_body_id, last_body_id FROM fts_backfill').fetchone()
+        if not row:
+            return
+        total = read_conn.execute('SELECT COUNT(*) FROM message_bodies WHERE body_id <= ?', (row[1],)).fetchone()[0]
+    done = 0
+    while True:
+        with manager.writer() as conn:
+            row = conn.execute('SELECT next_body_id, last_body_id FROM fts_backfill').fetchone()
+            if not row:
+                return
+            next_body_id, last_body_id = row
+            bodies = conn.execute('''
+                SELECT body_id, content FROM message_bodies WHERE body_id BETWEEN ? AND ?
+                ORDER BY body_id LIMIT ?
+            ''', (next_body_id, last_body_id, FTS_BACKFILL_BATCH)).fetchall()
+            conn.executemany('INSERT INTO messages_fts (rowid, content) VALUES (?, ?)',
+                             [(body_id, fts_segment(content)) for body_id, content in bodies])
+            if len(bodies) < FTS_BACKFILL_BATCH:
+                conn.execute('DELETE FROM fts_backfill')
+            else:
+                conn.execute('UPDATE fts_backfill SET next_body_id = ?', (bodies[-1][0] + 1,))
+            conn.commit()
+        done += len(bodies)
+        if on_progress:
+            on_progress(done, total)
+
+def build_fts_index_in_background():
+    """界面启动后在后台线程中补建全文索引，进度显示在状态栏。补建完成前内容搜索的结果不完整。"""
+    def on_progress(done, total):
+        root.after(0, status_var.set, f"正在建立全文索引: {done}/{total}，完成前内容搜索结果不完整")
+
+    def worker():
+        try:
+            with db.reader() as read_conn:
+                if not read_conn.execute('SELECT 1 FROM fts_backfill').fetchone():
+                    return
+            build_fts_index(db, on_progress)
+            root.after(0, status_var.set, "全文索引已建立")
+        except sqlite3.Error as e:
+            root.after(0, lambda msg=str(e): messagebox.showerror("建立全文索引失败", msg))
+
+    threading.Thread(target=worker, daemon=True).start()
+
+def build_fts_query(text):
+    """把用户输入转换为 FTS5 查询：每个词作为短语（AND 关系），最后一个词按前缀匹配。
+
+    中日韩文字按 fts_segment 相同的方式切成二元词组，组成短语后即可匹配任意子串。
+    以单个中日韩文字结尾的词无论位置都按前缀匹配，否则只能匹配到文字串末尾的那个字。
+    用户输入中的引号、括号、运算符等都按普通字符处理，不会造成语法错误。
+    """
+    terms = text.split()
+    if not terms:
+        return None
+    phrases = []
+    for index, term in enumerate(terms):
+        tokens = []
+        parts = TERM_PART_PATTERN.findall(term)
+        for part in parts:
+            if CJK_RUN_PATTERN.fullmatch(part):
+                tokens.extend(cjk_bigrams(part))
+            else:
+                tokens.append(part)
+        phrase = '"' + ' '.join(tokens).replace('"', '""') + '"'
+        if index == len(terms) - 1 or (len(parts[-1]) == 1 and CJK_RUN_PATTERN.fullmatch(parts[-1])):
+            phrase += '*'
+        phrases.append(phrase)
+    return ' '.join(phrases)
+
+def make_snippet(content, terms, width=48):
+    """从消息原文中截取第一个匹配词附近的片段，匹配词用【】标出。"""
+    content = ' '.join((content or '').split())
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    match = pattern.search(content)
+    start = max(0, match.start() - width // 4) if match else 0
+    snippet = content[start:start + width]
+    snippet = pattern.sub(lambda m: f"【{m.group()}】", snippet)
+    return ('…' if start > 0 else '') + snippet + ('…' if start + width < len(content) else '')
+
+def search_message_content(cursor, text):
+    """全文搜索消息内容，按 BM25 排名返回 [(conversation_id, conversation_name, snippet, message_id)]。
+
+    每个会话取得分最高的一条消息作为排名和匹配片段，匹配词用【】标出。
+    几乎每条消息都包含的常见词按 BM25 排名意义不大且很慢，这时按消息从新到旧返回。
+    查询为空时返回 None。
+    """
+    fts_query = build_fts_query(text)
+    if fts_query is None:
+        return None
+    cursor.execute('''
+        SELECT COUNT(*) FROM (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? LIMIT ?)
+    ''', (fts_query, CONTENT_SEARCH_RANK_LIMIT + 1))
+    if cursor.fetchone()[0] > CONTENT_SEARCH_RANK_LIMIT:
+        # 按 rowid 倒序扫描，取够条数即停止；用负的 rowid 作为排名，越新越靠前
+        hits_query = '''
+            SELECT rowid, -rowid AS rank FROM messages_fts WHERE messages_fts MATCH ?
+            ORDER BY rowid DESC LIMIT ?
+        '''
+    else:
+        hits_query = '''
+            SELECT rowid, rank FROM messages_fts WHERE messages_fts MATCH ?
+            ORDER BY rank LIMIT ?
+        '''
+    # 全文索引按正文建立（rowid 即 body_id）。先只取排名靠前的正文，再展开到引用它的消息并按会话分组；
+    # MIN() 时裸列 content 取自得分最高的那一行
+    cursor.execute(f'''
+        SELECT m.conversation_id, c.conversation_name, MIN(hits.rank), b.content, m.message_id
+        FROM ({hits_query}) AS hits
+        JOIN message_bodies b ON b.body_id = hits.rowid
+        JOIN messages m ON m.body_id = hits.rowid
+        JOIN conversations c ON c.conversation_id = m.conversation_id
+        GROUP BY m.conversation_id
+        ORDER BY MIN(hits.rank)
+        LIMIT ?
+    ''', (fts_query, CONTENT_SEARCH_HIT_LIMIT, CONTENT_SEARCH_RESULT_LIMIT))
+    terms = text.split()
+    return [(conversation_id, conversation_name, make_snippet(decode_content(content), terms), message_id)
+            for conversation_id, conversation_name, _, content, message_id in cursor.fetchall()]
+
+def benchmark_content_search(message_count=200000):
+    """在临时数据库中生成中英混合的消息，比较全文索引和 LIKE 全表扫描的搜索耗时。
+
+    词频按 Zipf 分布生成，分别测试高频、中频、低频词以及中英混合查询。
+    用法: python sharedchat_会话管理v2.1.py --benchmark-search [消息条数]
+    """
+    import random
+    import tempfile
+    rng = random.Random(0)
+    hanzi = [chr(code) for code in rng.sample(range(0x4e00, 0x9fa6), 800)]
+    chinese_words = sorted({''.join(rng.choices(hanzi, k=rng.choice((2, 2, 3, 4)))) for _ in range(5000)})
+    english_words = sorted({''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(3, 9))) for _ in range(5000)})
+    rng.shuffle(chinese_words)
+    rng.shuffle(english_words)
+    vocabulary = [word for pair in zip(chinese_words, english_words) for word in pair]
+    cum_weights = []
+    total = 0.0
+    for rank in range(len(vocabulary)):
+        total += 1.0 / (rank + 1)
+        cum_weights.append(total)
+
+    def sentence():
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(10, 80))
+        return ''.join(word if word[0] >= '\u3000' else f" {word} " for word in words) + "。"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        manager = init_db(os.path.join(temp_dir, 'benchmark.db'))
+        conn = manager.write_conn
+        cursor = conn.cursor()
+        conversation_count = max(1, message_count // 50)
+        cursor.executemany('INSERT INTO conversations (conversation_id, conversation_name) VALUES (?, ?)',
+                           [(f"c{i}", f"会话 {i}") for i in range(conversation_count)])
+        start = time.perf_counter()
+        rows = ((f"m{i}", f"c{i % conversation_count}", 'user', sentence(), str(i), float(i), format_timestamp(i))
+                for i in range(message_count))
+        insert_message_rows(cursor, rows, 5000)
+        conn.commit()
+        print(f"写入 {message_count} 条消息（含全文索引）: {time.perf_counter() - start:.1f} 秒")
+
+        queries = [
+            ("高频中文", vocabulary[2]), ("中频中文", vocabulary[100]), ("低频中文", vocabulary[3000]),
+            ("中文词的一部分", vocabulary[200][:2]), ("高频英文", vocabulary[3]), ("低频英文", vocabulary[3001]),
+            ("中英混合", f"{vocabulary[40]} {vocabulary[41]}"), ("不存在", "不存在的词"),
+        ]
+        print(f"{'查询':<12}{'':<16}{'全文索引(ms)':>12}{'LIKE(ms)':>10}{'匹配会话':>8}")
+        for label, query in queries:
+            start = time.perf_counter()
+            search_message_content(cursor, query)
+            fts_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            terms = query.split()
+            cursor.execute(
+                'SELECT DISTINCT m.conversation_id FROM messages m JOIN message_bodies b ON b.body_id = m.body_id WHERE '
+                + ' AND '.join('b.content LIKE ?' for _ in terms),
+                ['%' + term + '%' for term in terms])
+            matched = len(cursor.fetchall())
+            like_ms = (time.perf_counter() - start) * 1000
+            print(f"{label:<12}{query:<16}{fts_ms:>12.1f}{like_ms:>10.1f}{matched:>8}")
+        manager.close()
+
 def search_conversations(event=None):
     """根据搜索查询加载会话列表。"""
     global search_query
     search_query = search_entry.get()
     if search_query == search_hint:
         search_query = ""
-    load_conversations(conn, search_query)
+    load_conversations(conn, search_query, search_mode, conversation_sort)
+
+def on_search_mode_changed(event=None):
+    """切换按名称/按内容搜索。"""
+    global search_mode
+    search_mode = "content" if search_mode_combobox.get() == "搜索内容" else "name"
+    search_conversations()
+
+def on_sort_changed(event=None):
+    """切换会话列表的排序方式。"""
+    global conversation_sort
+    conversation_sort = list(CONVERSATION_SORT_ORDERS)[sort_combobox.current()]
+    search_conversations()
 
 # ====================== 右键菜单 ======================
 def on_right_click(event):
     """显示右键菜单。"""
     try:
-        selection = conversations_listbox.curselection()
-        if selection:
-            selected_item = conversations_listbox.get(selection[0])
-            conversation_id = selected_item.split('(')[-1].strip(')')
+        conversation_id = selected_list_conversation_id()
+        if conversation_id:
             menu = tk.Menu(root, tearoff=0)
             menu.add_command(label="删除", command=lambda: delete_conversation(conversation_id))
             menu.add_command(label="重命名", command=lambda: rename_conversation(conversation_id))
+            menu.add_command(label="查看导入记录", command=lambda: show_import_history(conversation_id))
             menu.add_command(label="导入并追加到此会话", command=lambda: import_json(filedialog.askopenfilename(filetypes=[("JSON Files", "*.json")]), conn, selected_conversation_id=conversation_id))
-            menu.add_command(label="导入并创建新会话", command=lambda: import_json(filedialog.askopenfilename(filetypes=[("JSON Files", "*.json")]), conn))
+            menu.add_command(label="导入并创建新会话", command=lambda: import_json(filedialog.askopenfilename(filetypes=IMPORT_FILETYPES), conn))
             menu.post(event.x_root, event.y_root)
     except tk.TclError:
         pass
 
 def delete_conversation(conversation_id):
-    """删除指定会话及其消息。"""
+    """删除指定会话及其消息和导入记录。"""
     try:
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM conversations WHERE conversation_id=?', (conversation_id,))
-        cursor.execute('DELETE FROM messages WHERE conversation_id=?', (conversation_id,))
-        conn.commit()
-        load_conversations(conn)
+        with db.writer() as write_conn:
+            cursor = write_conn.cursor()
+            cursor.execute('DELETE FROM conversations WHERE conversation_id=?', (conversation_id,))
+            cursor.execute('DELETE FROM messages WHERE conversation_id=?', (conversation_id,))
+            # 同时删除导入记录，否则重新导入同一文件会被当作已导入而跳过；
+            # 完整导出和压缩包中只要有一个会话被删除，整个文件的导入记录都要删除
+            cursor.execute('''
+                DELETE FROM import_ledger WHERE conversation_id=? OR content_hash IN
+                    (SELECT content_hash FROM import_ledger_conversations WHERE conversation_id=?)
+            ''', (conversation_id, conversation_id))
+            write_conn.commit()
+        schedule_conversation_list_refresh()
         messagebox.showinfo("成功", "会话已成功删除！")
     except sqlite3.Error as e:
         messagebox.showerror("错误", f"删除会话失败: {e}")
 
+def show_import_history(conversation_id):
+    """显示指定会话来自哪些导入文件。"""
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT imported_at, file_name, message_count FROM import_ledger
+            WHERE conversation_id=? OR content_hash IN
+                (SELECT content_hash FROM import_ledger_conversations WHERE conversation_id=?)
+            ORDER BY imported_at
+        ''', (conversation_id, conversation_id))
+        records = cursor.fetchall()
+        if not records:
+            messagebox.showinfo("导入记录", "没有该会话的导入记录。")
+            return
+        lines = [f"{imported_at}  {file_name}  {message_count} 条消息" for imported_at, file_name, message_count in records]
+        messagebox.showinfo("导入记录", "\n".join(lines))
+    except sqlite3.Error as e:
+        messagebox.showerror("错误", f"读取导入记录失败: {e}")
+
 def rename_conversation(conversation_id):
     """重命名指定会话。"""
     new_name = simpledialog.askstring("重命名", "请输入新的会话名称:")
     if new_name:
         try:
-            cursor = conn.cursor()
-            cursor.execute('UPDATE conversations SET conversation_name=? WHERE conversation_id=?', (new_name, conversation_id))
-            conn.commit()
-            load_conversations(conn)
+            with db.writer() as write_conn:
+                write_conn.execute('UPDATE conversations SET conversation_name=? WHERE conversation_id=?', (new_name, conversation_id))
+                write_conn.commit()
+            schedule_conversation_list_refresh()
             messagebox.showinfo("成功", "会话已成功重命名！")
         except sqlite3.Error as e:
             messagebox.showerror("错误", f"重命名会话失败: {e}")
 
 # ====================== 复制会话到剪贴板 ======================
 def copy_conversation_to_clipboard():
-    """将选定的会话复制到剪贴板。"""
+    """将选定的会话复制到剪贴板。有对话树时只复制当前分支，与显示和导出的内容一致。"""
     if not selected_conversation_id:
         messagebox.showwarning("未选择", "请选择一个会话以复制。")
         return
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT author_role, content, create_time FROM messages WHERE conversation_id=? ORDER BY create_time', (selected_conversation_id,))
-        messages = cursor.fetchall()
         conversation_text = ""
-        for msg in messages:
-            author_role, content, create_time = msg
-            conversation_text += f"{author_role}: {content}\n"
+        for messages in iter_conversation_pages(cursor, selected_conversation_id):
+            for _, _, author_role, content, _, _, _ in messages:
+                content = decode_content(content)
+                conversation_text += f"{author_role}: {content}\n"
         if len(conversation_text) <= 8000:
             root.clipboard_clear()
             root.clipboard_append(conversation_text)
@@ -638,7 +3217,8 @@ def toggle_theme():
     global is_dark_mode
     is_dark_mode = not is_dark_mode
     if selected_conversation_id:
-        load_messages(selected_conversation_id, conn, current_page)
+        # 只切换已加载文档的 body class，样式表中已有两种主题，不重新查询、渲染或加载文档
+        html_view.document.body.className = theme_class()
 
 # ====================== AI自动重命名 ======================
 def ai_automatic_rename():
@@ -648,104 +3228,225 @@ def ai_automatic_rename():
 
 def rename_conversations_in_background():
     """在后台线程中重命名会话。"""
-    # 创建一个新的SQLite连接用于线程
-    conn_thread = sqlite3.connect('conversations.db')
-    cursor_thread = conn_thread.cursor()
-
-    try:
-        # 查询所有会话
-        cursor_thread.execute("SELECT conversation_id, conversation_name FROM conversations")
-        conversations = cursor_thread.fetchall()
-
-        # 过滤出默认未命名的会话
-        unamed_conversations = [
-            (conversation_id, conversation_name)
-            for conversation_id, conversation_name in conversations
-            if re.match(default_name_pattern, conversation_name)
-        ][::-1]
-
-        if not unamed_conversations:
-            # 如果没有未命名的会话，显示提示信息
-            msg_box = tk.Toplevel(root)
-            msg_box.title("提示")
-            msg_box.geometry("300x100")
-            label = ttk.Label(msg_box, text="没有需要重命名的会话")
-            label.pack(pady=20)
-            # 3秒后关闭弹窗
-            root.after(3000, msg_box.destroy)
-            return
-
-        # 重命名每个符合条件的会话
-        for conversation_id, conversation_name in unamed_conversations:
-            cursor_thread.execute("""
-                SELECT content FROM messages 
-                WHERE conversation_id=? AND author_role='user' 
-                ORDER BY create_time LIMIT 1
-            """, (conversation_id,))
-            result = cursor_thread.fetchone()
-            if not result:
-                continue
-            first_user_message = result[0]
-            first_user_message = first_user_message[:500]
-
-            prompt = f"请将会话内容'{first_user_message}'整理为一个简洁的标题，不超过10个字。只输出标题，不要添加解释或说明。"
-
-            try:
-                response = client.chat.completions.create(
-                    model="llama3.2",
-                    messages=[
-                        {"role": "system", "content": "你是一个帮助重命名会话的助手。"},
-                        {"role": "user", "content": prompt},
-                    ],
-                    temperature=0.3,
-                    max_tokens=20
-                )
-                new_title = response.choices[0].message.content.strip()
+    # 从读连接池借用连接，更新会话名称时使用共享写连接
+    with db.reader() as conn_thread:
+        cursor_thread = conn_thread.cursor()
 
+        try:
+            # 查询所有会话
+            cursor_thread.execute("SELECT conversation_id, conversation_name FROM conversations")
+            conversations = cursor_thread.fetchall()
+
+            # 过滤出默认未命名的会话
+            unamed_conversations = [
+                (conversation_id, conversation_name)
+                for conversation_id, conversation_name in conversations
+                if re.match(default_name_pattern, conversation_name)
+            ][::-1]
+
+            if not unamed_conversations:
+                # 如果没有未命名的会话，显示提示信息
+                msg_box = tk.Toplevel(root)
+                msg_box.title("提示")
+                msg_box.geometry("300x100")
+                label = ttk.Label(msg_box, text="没有需要重命名的会话")
+                label.pack(pady=20)
+                # 3秒后关闭弹窗
+                root.after(3000, msg_box.destroy)
+                return
+
+            # 重命名每个符合条件的会话
+            for conversation_id, conversation_name in unamed_conversations:
                 cursor_thread.execute("""
-                    UPDATE conversations SET conversation_name=? WHERE conversation_id=?
-                """, (new_title, conversation_id))
-                conn_thread.commit()
-
-                root.after(0, lambda cid=conversation_id, name=new_title: update_conversation_name_in_list(cid, name))
+                    SELECT b.content FROM messages m JOIN message_bodies b ON b.body_id = m.body_id
+                    WHERE m.conversation_id=? AND m.author_role='user' 
+                    ORDER BY m.create_ts, m.rowid LIMIT 1
+                """, (conversation_id,))
+                result = cursor_thread.fetchone()
+                if not result:
+                    continue
+                first_user_message = decode_content(result[0]) or ""
+                first_user_message = first_user_message[:500]
+
+                prompt = f"请将会话内容'{first_user_message}'整理为一个简洁的标题，不超过10个字。只输出标题，不要添加解释或说明。"
+
+                try:
+                    response = client.chat.completions.create(
+                        model="llama3.2",
+                        messages=[
+                            {"role": "system", "content": "你是一个帮助重命名会话的助手。"},
+                            {"role": "user", "content": prompt},
+                        ],
+                        temperature=0.3,
+                        max_tokens=20
+                    )
+                    new_title = response.choices[0].message.content.strip()
+
+                    with db.writer() as write_conn:
+                        write_conn.execute("""
+                            UPDATE conversations SET conversation_name=? WHERE conversation_id=?
+                        """, (new_title, conversation_id))
+                        write_conn.commit()
+
+                    root.after(0, lambda cid=conversation_id, name=new_title: update_conversation_name_in_list(cid, name))
+
+                except Exception as e:
+                    # 在弹出窗口中显示错误信息
+                    error_msg = f"AI重命名失败: {e}"
+                    root.after(0, lambda msg=error_msg: messagebox.showerror("错误", msg))
+                    continue
 
-            except Exception as e:
-                # 在弹出窗口中显示错误信息
-                error_msg = f"AI重命名失败: {e}"
-                root.after(0, lambda msg=error_msg: messagebox.showerror("错误", msg))
-                continue
-
-    except sqlite3.Error as e:
-        # 在弹出窗口中显示数据库错误
-        error_msg = f"数据库操作失败: {e}"
-        root.after(0, lambda msg=error_msg: messagebox.showerror("数据库错误", msg))
-    finally:
-        conn_thread.close()
-        root.after(0, lambda: load_conversations(conn, search_query))
-        root.after(0, lambda: ai_rename_button.config(state="normal"))
+        except sqlite3.Error as e:
+            # 在弹出窗口中显示数据库错误
+            error_msg = f"数据库操作失败: {e}"
+            root.after(0, lambda msg=error_msg: messagebox.showerror("数据库错误", msg))
+        finally:
+            root.after(0, schedule_conversation_list_refresh)
+            root.after(0, lambda: ai_rename_button.config(state="normal"))
 
 def update_conversation_name_in_list(conversation_id, new_name):
     """更新会话列表中的会话名称。"""
-    # 遍历左侧会话列表找到对应的会话并更新其名称
-    for index in range(conversations_listbox.size()):
-        item_text = conversations_listbox.get(index)
-        # 找到对应的会话ID
-        if conversation_id in item_text:
-            # 更新显示的会话名称
+    for index, record in enumerate(displayed_conversations):
+        if record[0] == conversation_id:
+            selected = conversations_listbox.selection_includes(index)
+            record = (conversation_id, new_name) + record[2:]
             conversations_listbox.delete(index)
-            conversations_listbox.insert(index, f"{new_name} ({conversation_id})")
+            conversations_listbox.insert(index, format_conversation_item(*record))
+            displayed_conversations[index] = record
+            if selected:
+                conversations_listbox.selection_set(index)
             break
 
+# ====================== 下载目录监视 ======================
+# 浏览器下载过程中使用的临时文件后缀
+PARTIAL_DOWNLOAD_SUFFIXES = ('.crdownload', '.part', '.partial', '.download', '.tmp')
+
+def is_import_candidate(file_path):
+    """判断文件是否是已下载完成、可以自动导入的JSON文件或压缩包。
+
+    下载目录中还有各种无关的压缩包，自动导入只接受单个压缩的JSON文件（如 .json.gz）
+    和包含JSON文件的 zip；tar 包需要解压整个流才能知道内容，只能手动导入。
+    """
+    lower = file_path.lower()
+    if not lower.endswith(('.json', '.zip') + COMPRESSED_JSON_SUFFIXES) or not os.path.isfile(file_path):
+        return False
+    # Firefox 会先创建空的占位文件，再把 .part 文件改名覆盖它
+    if os.path.getsize(file_path) == 0:
+        return False
+    if any(os.path.exists(file_path + suffix) for suffix in PARTIAL_DOWNLOAD_SUFFIXES):
+        return False
+    if lower.endswith('.zip'):
+        return zip_contains_json(file_path)
+    return True
+
+def zip_contains_json(file_path):
+    """只读取 zip 的目录，判断其中是否有JSON文件。"""
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            return any(name.lower().endswith('.json') for name in archive.namelist())
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+class InotifyWatcher:
+    """基于 Linux inotify 的下载目录监视器。
+
+    只关注写完关闭（IN_CLOSE_WRITE）和改名移入（IN_MOVED_TO）的 .json 文件和压缩包，
+    一批连续到达的文件在安静 debounce 秒后只触发一次 on_files_ready()。
+    on_files_ready 在监视线程中调用。
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directory, on_files_ready, debounce):
+        self.directory = directory
+        self.on_files_ready = on_files_ready
+        self.debounce = debounce
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"无法监视目录 {directory}")
+        # 用于从 stop() 唤醒阻塞在 select 上的监视线程
+        self.wake_read, self.wake_write = os.pipe()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.wake_write, b'x')
+
+    def _run(self):
+        ready_at = None  # 最近一次有新文件后，计划触发导入的时间
+        try:
+            while True:
+                timeout = None if ready_at is None else max(0, ready_at - time.monotonic())
+                readable, _, _ = select.select([self.fd, self.wake_read], [], [], timeout)
+                if self.wake_read in readable:
+                    return
+                if self.fd in readable:
+                    if self._read_events():
+                        ready_at = time.monotonic() + self.debounce
+                elif ready_at is not None:
+                    ready_at = None
+                    self.on_files_ready()
+        finally:
+            for fd in (self.fd, self.wake_read, self.wake_write):
+                os.close(fd)
+
+    def _read_events(self):
+        """读取一批 inotify 事件，返回其中是否有可导入的文件。"""
+        data = os.read(self.fd, 64 * 1024)
+        found = False
+        offset = 0
+        while offset < len(data):
+            _, _, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            if name and is_import_candidate(os.path.join(self.directory, name)):
+                found = True
+        return found
+
+directory_watcher = None  # 当前的目录监视器，None 表示使用定时轮询
+
+def create_directory_watcher(directory, debounce):
+    """在支持的平台上创建目录监视器，不支持时返回 None。"""
+    if not sys.platform.startswith('linux') or not directory or not os.path.isdir(directory):
+        return None
+    try:
+        return InotifyWatcher(directory, lambda: root.after(0, batch_import_json, True), debounce)
+    except OSError:
+        return None
+
 # ====================== 主程序 ======================
 def main():
     """主程序入口。"""
-    global conn
-    conn = init_db()
-    if not conn:
+    global db, conn
+
+    def on_migration(description):
+        # 界面已经构建，升级数据库期间在状态栏显示正在执行的迁移
+        status_var.set(f"正在升级数据库: {description}……")
+        root.update()
+
+    db = init_db(on_migration=on_migration)
+    if not db:
         return
+    status_var.set("")
+    build_fts_index_in_background()
+    conn = db.connect_reader()
+    config = load_config()
+    content_codec.configure(config)
+    render_cache.configure(config)
+    content_codec.load_dictionaries(conn)
     load_conversations(conn)
     update_batch_import_button_text()  # 更新批量导入按钮的文本
-    config = load_config()
     if config["auto_import"]:
         # 启动自动导入线程
         start_auto_import()
@@ -755,133 +3456,186 @@ def main():
 def on_closing():
     """处理应用关闭事件，确保线程安全关闭。"""
     if messagebox.askokcancel("退出", "您确定要退出吗？"):
+        if current_import:
+            current_import.cancel()
+        if directory_watcher:
+            directory_watcher.stop()
+        prefetcher.shutdown()
+        if db:
+            try:
+                render_cache.flush(db)
+                # 大量导入后让 SQLite 按需更新统计信息
+                with db.writer() as write_conn:
+                    write_conn.execute('PRAGMA optimize')
+            except sqlite3.Error:
+                pass
         root.destroy()
 
 auto_import_job = None  # 用于保存自动导入的after job ID
 
 def start_auto_import():
-    """启动自动导入的定时器。"""
+    """启动自动导入：优先监视下载目录，不支持时退回到定时轮询。"""
+    global directory_watcher
     config = load_config()
+    directory_watcher = create_directory_watcher(config["download_directory"], config["auto_import_debounce"] / 1000)
+    if directory_watcher:
+        directory_watcher.start()
+        # 导入监视开始前已经存在的文件
+        batch_import_json(quiet=True)
+        return
     interval = config.get("auto_import_interval", 30000)
 
     def auto_import():
-        batch_import_json()
+        batch_import_json(quiet=True)
         global auto_import_job
         auto_import_job = root.after(interval, auto_import)  # 使用配置中的时间间隔
     auto_import()
 
 def restart_auto_import():
-    """重新启动自动导入，以应用新的时间间隔。"""
-    global auto_import_job
+    """重新启动自动导入，以应用新的下载目录和时间间隔。"""
+    global auto_import_job, directory_watcher
     if auto_import_job:
         root.after_cancel(auto_import_job)
         auto_import_job = None
-    start_auto_import()
+    if directory_watcher:
+        directory_watcher.stop()
+        directory_watcher = None
+    if load_config()["auto_import"]:
+        start_auto_import()
 
 # ====================== Tkinter界面构建 ======================
-# 创建主窗口
-root = tk.Tk()
-root.title("SharedChat会话管理工具v2.1")
-root.geometry("1000x700")
-
-# 创建顶部框架，用于按钮和搜索框
-top_frame = ttk.Frame(root)
-top_frame.pack(side=tk.TOP, fill=tk.X, pady=5)
-
-# 文件操作按钮框架
-file_button_frame = ttk.Frame(top_frame)
-file_button_frame.pack(side=tk.TOP, fill=tk.X)
-
-import_button = ttk.Button(file_button_frame, text="导入JSON", command=select_file)
-import_button.pack(side=tk.LEFT, padx=2)
-batch_import_button = ttk.Button(file_button_frame, text="批量导入JSON", command=select_directory_and_import)
-batch_import_button.pack(side=tk.LEFT, padx=2)
-save_button = ttk.Button(file_button_frame, text="保存为HTML", command=save_html_to_file)
-save_button.pack(side=tk.LEFT, padx=2)
-next_page_button = ttk.Button(file_button_frame, text="下一页", command=next_page)
-next_page_button.pack(side=tk.LEFT, padx=2)
-toggle_button = ttk.Button(file_button_frame, text="折叠对话列表", command=toggle_conversations_frame)
-toggle_button.pack(side=tk.LEFT, padx=2)
-theme_button = ttk.Button(file_button_frame, text="切换深色/浅色模式", command=toggle_theme)
-theme_button.pack(side=tk.LEFT, padx=2)
-# 复制到剪贴板按钮
-copy_button = ttk.Button(file_button_frame, text="复制到剪贴板", command=copy_conversation_to_clipboard)
-copy_button.pack(side=tk.LEFT, padx=2)
-# AI自动重命名按钮
-ai_rename_button = ttk.Button(file_button_frame, text="AI自动重命名", command=ai_automatic_rename)
-ai_rename_button.pack(side=tk.LEFT, padx=2)
-# 配置设置按钮
-config_button = ttk.Button(file_button_frame, text="配置设置", command=open_config_dialog)
-config_button.pack(side=tk.LEFT, padx=2)
-
-# 搜索框框架
-search_frame = ttk.Frame(top_frame)
-search_frame.pack(side=tk.TOP, fill=tk.X, pady=5)
-search_entry = tk.Entry(search_frame)
-search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
-# 默认搜索提示
-search_hint = "请输入搜索关键词"
-def set_search_hint():
-    if not search_entry.get():
-        search_entry.insert(0, search_hint)
-        search_entry.config(fg="grey")
-def clear_search_hint(event):
-    if search_entry.get() == search_hint:
-        search_entry.delete(0, tk.END)
-        search_entry.config(fg="black")
-def restore_search_hint(event):
-    if not search_entry.get():
-        set_search_hint()
-# 绑定事件
-search_entry.bind("<FocusIn>", clear_search_hint)
-search_entry.bind("<FocusOut>", restore_search_hint)
-search_entry.bind('<KeyRelease>', search_conversations)
-# 初始化搜索提示
-set_search_hint()
-
-# 创建PanedWindow，用于左右布局
-main_paned_window = tk.PanedWindow(root, orient=tk.HORIZONTAL)
-main_paned_window.pack(fill=tk.BOTH, expand=True)
-
-# 左侧会话列表框架
-conversations_frame = tk.Frame(main_paned_window)
-main_paned_window.add(conversations_frame, stretch='always')
-
-# 创建一个内部frame来容纳listbox和垂直滚动条
-listbox_frame = tk.Frame(conversations_frame)
-listbox_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=5, pady=5)
-
-conversations_listbox = tk.Listbox(
-    listbox_frame, font=("Arial", 12), selectbackground="#3399FF",
-    selectforeground="white", bg="#F7F9FC", fg="#333", bd=0, highlightthickness=0,
-    activestyle="none", relief="flat"
-)
-conversations_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-# 垂直滚动条
-scrollbar_conversations_y = ttk.Scrollbar(listbox_frame, orient=tk.VERTICAL, command=conversations_listbox.yview)
-scrollbar_conversations_y.pack(side=tk.RIGHT, fill=tk.Y)
-
-# 水平滚动条
-scrollbar_conversations_x = ttk.Scrollbar(conversations_frame, orient=tk.HORIZONTAL, command=conversations_listbox.xview)
-scrollbar_conversations_x.pack(side=tk.BOTTOM, fill=tk.X, padx=5)  # 保持与listbox相同的padding
-
-# 关联滚动条
-conversations_listbox.config(
-    xscrollcommand=scrollbar_conversations_x.set,
-    yscrollcommand=scrollbar_conversations_y.set
-)
-
-conversations_listbox.bind('<<ListboxSelect>>', on_select_conversation)
-conversations_listbox.bind('<Button-3>', on_right_click)
-
-
-# 右侧消息显示框架
-messages_frame = tk.Frame(main_paned_window)
-main_paned_window.add(messages_frame, stretch='always')
-html_view = HtmlFrame(messages_frame, horizontal_scrollbar="auto", messages_enabled = False)
-html_view.pack(fill="both", expand=True)
-
-# ====================== 启动主程序 ======================
+# 进程池以 spawn 方式启动解析进程时会重新导入本模块，界面只在主进程中构建
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark-search':
+        benchmark_content_search(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
+        sys.exit(0)
+
+    # 创建主窗口
+    root = tk.Tk()
+    root.title("SharedChat会话管理工具v2.1")
+    root.geometry("1000x700")
+
+    # 创建顶部框架，用于按钮和搜索框
+    top_frame = ttk.Frame(root)
+    top_frame.pack(side=tk.TOP, fill=tk.X, pady=5)
+
+    # 文件操作按钮框架
+    file_button_frame = ttk.Frame(top_frame)
+    file_button_frame.pack(side=tk.TOP, fill=tk.X)
+
+    import_button = ttk.Button(file_button_frame, text="导入JSON", command=select_file)
+    import_button.pack(side=tk.LEFT, padx=2)
+    batch_import_button = ttk.Button(file_button_frame, text="批量导入JSON", command=select_directory_and_import)
+    batch_import_button.pack(side=tk.LEFT, padx=2)
+    save_button = ttk.Button(file_button_frame, text="保存为HTML", command=save_html_to_file)
+    save_button.pack(side=tk.LEFT, padx=2)
+    previous_page_button = ttk.Button(file_button_frame, text="上一页", command=previous_page)
+    previous_page_button.pack(side=tk.LEFT, padx=2)
+    next_page_button = ttk.Button(file_button_frame, text="下一页", command=next_page)
+    next_page_button.pack(side=tk.LEFT, padx=2)
+    last_page_button = ttk.Button(file_button_frame, text="跳到末尾", command=last_page)
+    last_page_button.pack(side=tk.LEFT, padx=2)
+    toggle_button = ttk.Button(file_button_frame, text="折叠对话列表", command=toggle_conversations_frame)
+    toggle_button.pack(side=tk.LEFT, padx=2)
+    theme_button = ttk.Button(file_button_frame, text="切换深色/浅色模式", command=toggle_theme)
+    theme_button.pack(side=tk.LEFT, padx=2)
+    # 复制到剪贴板按钮
+    copy_button = ttk.Button(file_button_frame, text="复制到剪贴板", command=copy_conversation_to_clipboard)
+    copy_button.pack(side=tk.LEFT, padx=2)
+    # AI自动重命名按钮
+    ai_rename_button = ttk.Button(file_button_frame, text="AI自动重命名", command=ai_automatic_rename)
+    ai_rename_button.pack(side=tk.LEFT, padx=2)
+    # 配置设置按钮
+    config_button = ttk.Button(file_button_frame, text="配置设置", command=open_config_dialog)
+    config_button.pack(side=tk.LEFT, padx=2)
+
+    # 搜索框框架
+    search_frame = ttk.Frame(top_frame)
+    search_frame.pack(side=tk.TOP, fill=tk.X, pady=5)
+    # 搜索方式选择
+    search_mode_combobox = ttk.Combobox(search_frame, values=["搜索名称", "搜索内容"], state="readonly", width=8)
+    search_mode_combobox.current(0)
+    search_mode_combobox.pack(side=tk.RIGHT, padx=2)
+    search_mode_combobox.bind("<<ComboboxSelected>>", on_search_mode_changed)
+    # 会话列表排序方式
+    sort_combobox = ttk.Combobox(search_frame, values=[label for label, _ in CONVERSATION_SORT_ORDERS.values()],
+                                 state="readonly", width=8)
+    sort_combobox.current(0)
+    sort_combobox.pack(side=tk.RIGHT, padx=2)
+    sort_combobox.bind("<<ComboboxSelected>>", on_sort_changed)
+    search_entry = tk.Entry(search_frame)
+    search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+    # 默认搜索提示
+    search_hint = "请输入搜索关键词"
+    def set_search_hint():
+        if not search_entry.get():
+            search_entry.insert(0, search_hint)
+            search_entry.config(fg="grey")
+    def clear_search_hint(event):
+        if search_entry.get() == search_hint:
+            search_entry.delete(0, tk.END)
+            search_entry.config(fg="black")
+    def restore_search_hint(event):
+        if not search_entry.get():
+            set_search_hint()
+    # 绑定事件
+    search_entry.bind("<FocusIn>", clear_search_hint)
+    search_entry.bind("<FocusOut>", restore_search_hint)
+    search_entry.bind('<KeyRelease>', search_conversations)
+    # 初始化搜索提示
+    set_search_hint()
+
+    # 底部状态栏，用于显示导入进度
+    status_var = tk.StringVar(value="")
+    status_label = ttk.Label(root, textvariable=status_var, anchor='w')
+    status_label.pack(side=tk.BOTTOM, fill=tk.X, padx=5)
+
+    # 创建PanedWindow，用于左右布局
+    main_paned_window = tk.PanedWindow(root, orient=tk.HORIZONTAL)
+    main_paned_window.pack(fill=tk.BOTH, expand=True)
+
+    # 左侧会话列表框架
+    conversations_frame = tk.Frame(main_paned_window)
+    main_paned_window.add(conversations_frame, stretch='always')
+
+    # 创建一个内部frame来容纳listbox和垂直滚动条
+    listbox_frame = tk.Frame(conversations_frame)
+    listbox_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+    conversations_listbox = tk.Listbox(
+        listbox_frame, font=("Arial", 12), selectbackground="#3399FF",
+        selectforeground="white", bg="#F7F9FC", fg="#333", bd=0, highlightthickness=0,
+        activestyle="none", relief="flat"
+    )
+    conversations_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+    # 垂直滚动条
+    scrollbar_conversations_y = ttk.Scrollbar(listbox_frame, orient=tk.VERTICAL, command=conversations_listbox.yview)
+    scrollbar_conversations_y.pack(side=tk.RIGHT, fill=tk.Y)
+
+    # 水平滚动条
+    scrollbar_conversations_x = ttk.Scrollbar(conversations_frame, orient=tk.HORIZONTAL, command=conversations_listbox.xview)
+    scrollbar_conversations_x.pack(side=tk.BOTTOM, fill=tk.X, padx=5)  # 保持与listbox相同的padding
+
+    # 关联滚动条
+    conversations_listbox.config(
+        xscrollcommand=scrollbar_conversations_x.set,
+        yscrollcommand=scrollbar_conversations_y.set
+    )
+
+    conversations_listbox.bind('<<ListboxSelect>>', on_select_conversation)
+    conversations_listbox.bind('<Button-3>', on_right_click)
+
+
+    # 右侧消息显示框架
+    messages_frame = tk.Frame(main_paned_window)
+    main_paned_window.add(messages_frame, stretch='always')
+    # 会话滚动条表示整个会话，文档中只保留其中的一部分消息
+    conversation_scrollbar = ttk.Scrollbar(messages_frame, orient=tk.VERTICAL, command=on_conversation_scroll)
+    conversation_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+    html_view = HtmlFrame(messages_frame, horizontal_scrollbar="auto", messages_enabled = False,
+                          on_link_click=on_message_link_click)
+    html_view.pack(fill="both", expand=True)
+
+    # ====================== 启动主程序 ======================
     main()